@@ -1,16 +1,46 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Request
 from motor.motor_asyncio import AsyncIOMotorClient
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 from typing import Optional
 from passlib.context import CryptContext
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 from models import UserSignup, UserLogin
 from database import db
+from leaderboard import record_group_points, record_many_group_points, group_key
+from user_cache import get_user, invalidate_user
+from mentors import mentor_directory, attach_mentees
+from executors import BoundedExecutor, ExecutorSaturated
 from uuid import uuid4
+import asyncio
+import csv
+import io
+import json
+import os
 
 auth_router = APIRouter()
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing (raise BCRYPT_ROUNDS over time; old hashes get upgraded on login)
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# bcrypt is slow on purpose, so it runs on its own small pool instead of the event loop
+hash_executor = BoundedExecutor(
+    "bcrypt",
+    max_workers=int(os.getenv("BCRYPT_WORKERS", 4)),
+    max_queue=int(os.getenv("BCRYPT_MAX_QUEUE", 64)),
+)
+
+# Bulk imports hash a whole cohort at once, so they get processes (one per core)
+# and leave the thread pool above free for regular logins
+bulk_hash_executor = BoundedExecutor(
+    "bcrypt-bulk",
+    max_workers=os.cpu_count() or 2,
+    max_queue=int(os.getenv("BCRYPT_BULK_MAX_QUEUE", 16)),
+    processes=True,
+)
+
+MAX_BULK_SIGNUP_ROWS = int(os.getenv("MAX_BULK_SIGNUP_ROWS", 5000))
+DUPLICATE_KEY_ERROR = 11000
 
 # Helper functions
 def get_password_hash(password: str):
@@ -19,57 +49,213 @@ def get_password_hash(password: str):
 def verify_password(plain_password: str, hashed_password: str):
     return pwd_context.verify(plain_password, hashed_password)
 
+def get_password_hashes(passwords: list):
+    # Runs in a worker process, so it has to be a plain module-level function
+    return [pwd_context.hash(password) for password in passwords]
+
+def user_response(db_user: dict):
+    # What signup and login send back about the user
+    return {
+        "id": str(db_user["_id"]),
+        "accountType": db_user["accountType"],
+        "fullName": db_user["fullName"],
+        "email": db_user["email"],
+        "mentor_name": db_user.get("mentor_name"),
+        "mentor_id": str(db_user["mentor_id"]) if db_user.get("mentor_id") else None,
+        "profile_pic": db_user.get("profile_pic"),
+        "fun_facts": db_user.get("fun_facts"),
+    }
+
+def empty_bucket_list(mentor_id, mentor_name: str):
+    return {
+        "_id": str(uuid4()),
+        "mentor_id": mentor_id,
+        "mentor_name": mentor_name,
+        # The tasks themselves live in the tasks collection
+        "task_count": 0,
+        "completed_count": 0,
+    }
+
+async def run_hashing(fn, *args):
+    try:
+        return await hash_executor.run(fn, *args)
+    except ExecutorSaturated:
+        raise HTTPException(
+            status_code=503,
+            detail="Server is busy, please try again",
+            headers={"Retry-After": "1"}
+        )
+
+async def hash_password(password: str):
+    return await run_hashing(get_password_hash, password)
+
+async def verify_and_update_password(plain_password: str, hashed_password: str):
+    """
+    Checks the password and, if the stored hash uses old settings (e.g. fewer
+    rounds), also returns a fresh hash to save. Returns (valid, new_hash or None).
+    """
+    return await run_hashing(pwd_context.verify_and_update, plain_password, hashed_password)
+
 # Routes
 @auth_router.post("/signup")
 async def signup(user: UserSignup):
-    # Checking if user already exists
-    if await db.users.find_one({"email": user.email}):
-        raise HTTPException(status_code=400, detail="Email already registered")
-    
     # Create user with hashed password
     user_dict = user.model_dump()
-    user_dict["password"] = get_password_hash(user_dict["password"])
-    result = await db.users.insert_one(user_dict)
+    user_dict["password"] = await hash_password(user_dict["password"])
+    # Groups are joined on the mentor's id; None until the mentor signs up
+    user_dict["mentor_id"] = await mentor_directory.resolve(user_dict["mentor_name"])
+    # An old name still finds a renamed mentor; store the current one
+    user_dict["mentor_name"] = mentor_directory.name_of(user_dict["mentor_id"]) or user_dict["mentor_name"]
 
-    # Create empty bucket list for mentors
+    # The unique email index rejects duplicates, no need to look first
+    try:
+        result = await db.users.insert_one(user_dict)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
+    user_dict["_id"] = result.inserted_id
+
+    await record_group_points(group_key(user_dict["mentor_name"], user_dict["mentor_id"]), user_dict["points"])
+    invalidate_user(user.email)
+
+    # Create empty bucket list for mentors, and bring in anyone who signed up with them first
     if user_dict["accountType"] == "Mentor":
-        bucket_list = {
-            "_id": str(uuid4()),
-            "mentor_name": user.fullName,
-            "tasks": []  # Empty tasks array instead of default task
-        }
-        # Insert the bucket list into the database
-        await db.bucket_lists.insert_one(bucket_list)
-
-    db_user = await db.users.find_one({"email": user.email})
+        mentor_directory.add(user_dict["_id"], user.fullName)
+        await db.bucket_lists.insert_one(empty_bucket_list(user_dict["_id"], user.fullName))
+        await attach_mentees([(user_dict["_id"], user.fullName)])
+
     # Return the same user information as login
-    return {"message": "Signup successful", "user": {
-        "id": str(db_user["_id"]),
-        "accountType": db_user["accountType"],
-        "fullName": db_user["fullName"],
-        "email": db_user["email"],
-        "mentor_name": db_user["mentor_name"],
-        "profile_pic": db_user["profile_pic"] if "profile_pic" in db_user else None,
-        "fun_facts": db_user["fun_facts"],
-    }}
+    return {"message": "Signup successful", "user": user_response(user_dict)}
+
+def parse_signup_rows(body: bytes, content_type: str):
+    """
+    Reading a CSV (with a header row) or JSON-lines upload into a list of
+    (row number, fields dict or None, parse error or None)
+    """
+    text = body.decode("utf-8-sig")
+    rows = []
+    if "csv" in content_type:
+        for number, row in enumerate(csv.DictReader(io.StringIO(text)), start=1):
+            # blank CSV cells mean "not given"
+            rows.append((number, {k: v for k, v in row.items() if k and v not in (None, "")}, None))
+    else:
+        for number, line in enumerate(text.splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                rows.append((number, json.loads(line), None))
+            except json.JSONDecodeError as e:
+                rows.append((number, None, f"Invalid JSON: {e}"))
+    return rows
+
+# Bulk signup for a whole cohort: CSV (text/csv) or JSON lines (application/x-ndjson)
+@auth_router.post("/signup/bulk")
+async def bulk_signup(request: Request):
+    content_type = request.headers.get("content-type", "")
+    rows = parse_signup_rows(await request.body(), content_type)
+    if not rows:
+        raise HTTPException(status_code=400, detail="No rows to import")
+    if len(rows) > MAX_BULK_SIGNUP_ROWS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_SIGNUP_ROWS} rows per import")
+
+    report = {}
+    users = []  # (row number, UserSignup)
+    for number, fields, error in rows:
+        if error:
+            report[number] = {"row": number, "status": "error", "error": error}
+            continue
+        if not isinstance(fields, dict):
+            report[number] = {"row": number, "status": "error", "error": "Row must be an object"}
+            continue
+        try:
+            users.append((number, UserSignup(**fields)))
+        except ValidationError as e:
+            problems = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+            report[number] = {"row": number, "email": fields.get("email"), "status": "error", "error": problems}
+
+    if users:
+        # Hash in batches spread over the process pool
+        passwords = [user.password for _, user in users]
+        batch_size = max(1, -(-len(passwords) // bulk_hash_executor.max_workers))
+        batches = [passwords[i:i + batch_size] for i in range(0, len(passwords), batch_size)]
+        try:
+            hashed_batches = await asyncio.gather(
+                *[bulk_hash_executor.run(get_password_hashes, batch) for batch in batches]
+            )
+        except ExecutorSaturated:
+            raise HTTPException(status_code=503, detail="Server is busy, please try again", headers={"Retry-After": "5"})
+        hashes = [h for batch in hashed_batches for h in batch]
+
+        # Mentors created by this same import are linked up after the insert
+        mentor_ids = await mentor_directory.resolve_many(user.mentor_name for _, user in users)
+        docs = []
+        for (_, user), password_hash in zip(users, hashes):
+            doc = user.model_dump()
+            doc["password"] = password_hash
+            doc["mentor_id"] = mentor_ids[user.mentor_name]
+            doc["mentor_name"] = mentor_directory.name_of(doc["mentor_id"]) or user.mentor_name
+            docs.append(doc)
+
+        # Unordered so one duplicate doesn't stop the rest; the unique email index finds duplicates
+        failed = {}
+        try:
+            await db.users.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            for write_error in e.details.get("writeErrors", []):
+                if write_error.get("code") == DUPLICATE_KEY_ERROR:
+                    failed[write_error["index"]] = "Email already registered"
+                else:
+                    failed[write_error["index"]] = write_error.get("errmsg", "Insert failed")
+
+        bucket_lists = []
+        mentors = []
+        group_points = {}
+        for index, ((number, user), doc) in enumerate(zip(users, docs)):
+            if index in failed:
+                report[number] = {"row": number, "email": user.email, "status": "error", "error": failed[index]}
+                continue
+            report[number] = {"row": number, "email": user.email, "status": "created", "id": str(doc["_id"])}
+            invalidate_user(user.email)
+            if user.accountType == "Mentor":
+                mentor_directory.add(doc["_id"], user.fullName)
+                mentors.append((doc["_id"], user.fullName))
+                bucket_lists.append(empty_bucket_list(doc["_id"], user.fullName))
+            group = group_key(doc["mentor_name"], doc["mentor_id"])
+            if group is not None and user.points:
+                group_points[group] = group_points.get(group, 0) + user.points
+
+        # Before linking, which moves the totals of groups whose mentor was in this import
+        await record_many_group_points(group_points)
+        if bucket_lists:
+            await db.bucket_lists.insert_many(bucket_lists, ordered=False)
+            await attach_mentees(mentors)
+
+    results = [report[number] for number in sorted(report)]
+    created = sum(1 for r in results if r["status"] == "created")
+    return {
+        "message": "Import finished",
+        "created": created,
+        "failed": len(results) - created,
+        "results": results
+    }
 
 @auth_router.post("/login")
 async def login(user: UserLogin):
     # Finding user
-    db_user = await db.users.find_one({"email": user.email})
+    db_user = await get_user(user.email)
     if not db_user:
         raise HTTPException(status_code=400, detail="Invalid email or password")
     
     # Verify password
-    if not verify_password(user.password, db_user["password"]):
+    valid, new_hash = await verify_and_update_password(user.password, db_user["password"])
+    if not valid:
         raise HTTPException(status_code=400, detail="Invalid email or password")
+
+    # Upgrade hashes made with outdated settings now that we know the password
+    if new_hash:
+        await db.users.update_one(
+            {"_id": db_user["_id"], "password": db_user["password"]},
+            {"$set": {"password": new_hash}}
+        )
+        invalidate_user(user.email)
     
-    return {"message": "Login successful", "user": {
-        "id": str(db_user["_id"]),
-        "accountType": db_user["accountType"],
-        "fullName": db_user["fullName"],
-        "email": db_user["email"],
-        "mentor_name": db_user["mentor_name"],
-        "profile_pic": db_user["profile_pic"] if "profile_pic" in db_user else None,
-        "fun_facts": db_user["fun_facts"],
-    }}
\ No newline at end of file
+    return {"message": "Login successful", "user": user_response(db_user)}
\ No newline at end of file
@@ -0,0 +1,494 @@
+"""
+Benchmarking every router against a seeded database.
+
+Seeds thousands of users across mentor groups, a bucket list with hundreds of
+tasks per group and avatars of different sizes, then hits every endpoint with
+concurrent requests through httpx's ASGI transport (no server, no network) and
+reports throughput, p50/p95/p99 latency and peak memory per endpoint.
+
+    python benchmark.py                                    # in-process fake Mongo (pip install mongomock-motor)
+    python benchmark.py --mongo-uri mongodb://localhost    # a local mongod, in a throwaway database
+    python benchmark.py --save-baseline bench_baseline.json
+    python benchmark.py --baseline bench_baseline.json     # exits 1 if anything got slower than --threshold
+
+Baselines only mean something on the machine (and mode) they were recorded on.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import sys
+import time
+from datetime import datetime, timezone
+from uuid import uuid4
+from bson import ObjectId
+
+BENCHMARK_DATABASE = "bootcamp_benchmark"
+PASSWORD = "benchmark-password"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark every endpoint against a seeded database")
+    parser.add_argument("--mongo-uri", help="Run against this mongod instead of the in-process fake")
+    parser.add_argument("--students", type=int, default=2000)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--tasks", type=int, default=200, help="Tasks per bucket list")
+    parser.add_argument("--avatars", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=200, help="Measured requests per endpoint")
+    parser.add_argument("--warmup", type=int, default=10, help="Unmeasured requests per endpoint first")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--bcrypt-rounds", type=int, default=12)
+    parser.add_argument("--only", nargs="*", help="Only run endpoints whose name starts with one of these")
+    parser.add_argument("--baseline", help="Compare against this baseline file")
+    parser.add_argument("--save-baseline", help="Write the results to this baseline file")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed slowdown before it counts as a regression (0.25 = 25%%)")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--verbose", action="store_true", help="Show the app's own prints while running")
+    return parser.parse_args()
+
+def configure_environment(args):
+    """
+    Settings the app reads at import time, so this runs before importing it
+    """
+    os.environ["MONGODB_DATABASE"] = BENCHMARK_DATABASE
+    os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    os.environ["IMAGE_GC_INTERVAL_SECONDS"] = "0"
+    # Profile pictures go to GridFS, never to a real Cloudinary account
+    for name in ("CLOUDINARY_CLOUD_NAME", "CLOUDINARY_API_KEY", "CLOUDINARY_API_SECRET", "UPLOAD_JOB_UPLOADER"):
+        os.environ[name] = ""
+    if args.mongo_uri:
+        os.environ["MONGODB_URI"] = args.mongo_uri
+    else:
+        use_fake_mongo()
+
+def use_fake_mongo():
+    """
+    Swapping Motor for mongomock-motor, plus the bits it doesn't cover (GridFS,
+    db.fs.files style sub-collections). Queries it can't run show up as errors
+    for that endpoint; use --mongo-uri for those.
+    """
+    try:
+        from mongomock_motor import AsyncMongoMockClient, AsyncMongoMockCollection
+    except ImportError:
+        sys.exit("The fake database needs mongomock-motor (pip install mongomock-motor), or pass --mongo-uri")
+    import mongomock.collection
+    import motor.motor_asyncio
+
+    shared_client = AsyncMongoMockClient()
+    motor.motor_asyncio.AsyncIOMotorClient = lambda *args, **kwargs: shared_client
+    motor.motor_asyncio.AsyncIOMotorGridFSBucket = FakeGridFSBucket
+
+    # db.fs.files comes back as a plain mongomock collection otherwise
+    plain_getattr = AsyncMongoMockCollection.__getattr__
+
+    def sub_collection(self, name):
+        value = plain_getattr(self, name)
+        if isinstance(value, mongomock.collection.Collection):
+            return AsyncMongoMockCollection(self.database, value)
+        return value
+    AsyncMongoMockCollection.__getattr__ = sub_collection
+
+    # mongomock doesn't know UpdateOne/UpdateMany's sort argument
+    plain_add_update = mongomock.collection.BulkOperationBuilder.add_update
+
+    def add_update(self, *args, sort=None, **kwargs):
+        return plain_add_update(self, *args, **kwargs)
+    mongomock.collection.BulkOperationBuilder.add_update = add_update
+
+class FakeGridIn:
+    """
+    Just enough of Motor's GridIn for image_store.save_stream
+    """
+
+    def __init__(self, db, filename, metadata, chunk_size):
+        self._db = db
+        self._id = ObjectId()
+        self.filename = filename
+        self.metadata = metadata
+        self.chunk_size = chunk_size
+        self.length = 0
+        self.upload_date = None
+        self._buffer = bytearray()
+        self._n = 0
+        self._fields = {}
+
+    async def _flush(self, data):
+        await self._db["fs.chunks"].insert_one({"files_id": self._id, "n": self._n, "data": bytes(data)})
+        self._n += 1
+
+    async def write(self, data):
+        self._buffer += data
+        self.length += len(data)
+        while len(self._buffer) >= self.chunk_size:
+            await self._flush(self._buffer[:self.chunk_size])
+            del self._buffer[:self.chunk_size]
+
+    async def set(self, name, value):
+        self._fields[name] = value
+
+    async def close(self):
+        if self._buffer:
+            await self._flush(self._buffer)
+            self._buffer = bytearray()
+        self.upload_date = datetime.now(timezone.utc).replace(tzinfo=None)
+        await self._db["fs.files"].insert_one({
+            "_id": self._id,
+            "filename": self.filename,
+            "metadata": self.metadata,
+            "length": self.length,
+            "chunkSize": self.chunk_size,
+            "uploadDate": self.upload_date,
+            **self._fields,
+        })
+
+    async def abort(self):
+        await self._db["fs.chunks"].delete_many({"files_id": self._id})
+
+class FakeGridFSBucket:
+    def __init__(self, db, chunk_size_bytes=255 * 1024, **kwargs):
+        self._db = db
+        self.chunk_size = chunk_size_bytes
+
+    def open_upload_stream(self, filename, metadata=None, **kwargs):
+        return FakeGridIn(self._db, filename, metadata or {}, self.chunk_size)
+
+def make_image(size_bytes: int, rng: random.Random):
+    """
+    A PNG of roughly size_bytes (random pixels barely compress), or random
+    bytes when Pillow isn't installed
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return rng.randbytes(size_bytes), "image/jpeg"
+    side = max(int((size_bytes / 3) ** 0.5), 8)
+    image = Image.frombytes("RGB", (side, side), rng.randbytes(side * side * 3))
+    out = io.BytesIO()
+    image.save(out, format="PNG", compress_level=1)
+    return out.getvalue(), "image/png"
+
+async def iter_data(data: bytes):
+    yield data
+
+async def seed(args, db, rng):
+    """
+    Writing the dataset straight to the database (bypassing the API is much faster)
+    and returning what the scenarios need to build requests
+    """
+    from auth import get_password_hash, empty_bucket_list
+    from image_records import store_image
+    from image_variants import _background_builds
+
+    for name in await db.list_collection_names():
+        await db.drop_collection(name)
+
+    # Every user gets the same password, so it's only hashed once
+    password_hash = get_password_hash(PASSWORD)
+
+    mentors = [f"Mentor {g}" for g in range(args.groups)]
+    users = []
+    for g, mentor in enumerate(mentors):
+        users.append({
+            "fullName": mentor, "email": f"mentor{g}@bench.local", "accountType": "Mentor",
+            "mentor_name": mentor, "fun_facts": "", "points": rng.randint(0, 500),
+            "profile_pic": None, "password": password_hash,
+        })
+    students = []
+    for i in range(args.students):
+        email = f"student{i}@bench.local"
+        students.append(email)
+        users.append({
+            "fullName": f"Student {i}", "email": email, "accountType": "Student",
+            "mentor_name": mentors[i % len(mentors)], "fun_facts": "", "points": rng.randint(0, 500),
+            "profile_pic": None, "password": password_hash,
+        })
+    for offset in range(0, len(users), 1000):
+        await db.users.insert_many(users[offset:offset + 1000])
+
+    tasks = {}
+    bucket_lists = []
+    # Mentees are seeded by name only, like data from before mentor ids; startup links them up
+    for g, mentor in enumerate(mentors):
+        bucket_list = empty_bucket_list(users[g]["_id"], mentor)
+        bucket_list["tasks"] = [
+            {"id": str(uuid4()), "description": f"Task {t}", "completed": rng.random() < 0.3}
+            for t in range(args.tasks)
+        ]
+        tasks[mentor] = [task["id"] for task in bucket_list["tasks"]]
+        bucket_lists.append(bucket_list)
+    await db.bucket_lists.insert_many(bucket_lists)
+
+    # Avatars from 16 KB to 4 MB, and every tenth one is the shared default picture
+    sizes = [16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+    default_avatar = make_image(32 * 1024, rng)
+    images = []
+    for i in range(min(args.avatars, len(students))):
+        email = students[i]
+        data, content_type = default_avatar if i % 10 == 0 else make_image(sizes[i % len(sizes)], rng)
+        metadata = {"filename": f"{email}_profile.png", "content_type": content_type, "user_id": email, "is_profile_picture": True}
+        image_id, _, _ = await store_image(iter_data(data), metadata["filename"], metadata)
+        await db.users.update_one({"email": email}, {"$set": {"profile_pic": f"/images/{image_id}"}})
+        images.append((str(image_id), email))
+
+    # Let the resized copies finish so they don't steal CPU from the measurements
+    while _background_builds:
+        await asyncio.gather(*list(_background_builds), return_exceptions=True)
+
+    return {
+        "mentors": mentors,
+        "mentor_emails": {mentor: f"mentor{g}@bench.local" for g, mentor in enumerate(mentors)},
+        "students": students,
+        "tasks": tasks,
+        "images": images,
+        "etags": {},
+        "signups": 0,
+    }
+
+OK = range(200, 300)
+
+def scenarios(data, rng):
+    """
+    (name, request builder, statuses that count as success) for every endpoint.
+    Builders return (method, url, httpx keyword arguments).
+    """
+    def student():
+        return rng.choice(data["students"])
+
+    def mentor():
+        return rng.choice(data["mentors"])
+
+    def image():
+        return rng.choice(data["images"])[0]
+
+    def signup():
+        data["signups"] += 1
+        return ("POST", "/auth/signup", {"json": {
+            "email": f"new{data['signups']}-{uuid4().hex[:8]}@bench.local", "fullName": "New Student",
+            "accountType": "Student", "mentor_name": mentor(), "password": PASSWORD,
+        }})
+
+    def toggle():
+        name = mentor()
+        return ("PUT", f"/bucketlist/{name}/bucket_lists/toggle/{rng.choice(data['tasks'][name])}",
+                {"params": {"user_email": data["mentor_emails"][name]}, "json": {"completed": rng.random() < 0.5}})
+
+    def add_task():
+        name = mentor()
+        return ("POST", f"/bucketlist/{name}/bucket_lists",
+                {"params": {"user_email": data["mentor_emails"][name]}, "json": {"description": "Benchmark task"}})
+
+    def delete_task():
+        name = mentor()
+        # Each delete takes a task off the end of the seeded list, so it always exists
+        task_id = data["tasks"][name].pop() if len(data["tasks"][name]) > 1 else "missing"
+        return ("DELETE", f"/bucketlist/{name}/bucket_lists/task/{task_id}",
+                {"params": {"user_email": data["mentor_emails"][name]}})
+
+    def conditional_image():
+        image_id = image()
+        etag = data["etags"].get(image_id, '"none"')
+        return ("GET", f"/images/{image_id}", {"headers": {"If-None-Match": etag}})
+
+    def upload_image():
+        content, content_type = make_image(8 * 1024, rng)
+        return ("POST", "/images/upload", {"files": {"file": ("bench.png", content, content_type)}})
+
+    def upload_profile_image():
+        content, content_type = make_image(8 * 1024, rng)
+        return ("PUT", "/profile/image", {"params": {"email": student()}, "content": content,
+                                          "headers": {"Content-Type": content_type}})
+
+    return [
+        ("auth_signup", signup, OK),
+        ("auth_login", lambda: ("POST", "/auth/login", {"json": {"email": student(), "password": PASSWORD}}), OK),
+        ("profile_get", lambda: ("GET", "/profile", {"params": {"email": student()}}), OK),
+        ("profile_update", lambda: ("PUT", "/profile", {"params": {"email": student()}, "json": {"fun_facts": uuid4().hex}}), OK),
+        ("profile_by_role", lambda: ("GET", "/profile/role/Student", {"params": {"limit": 50}}), OK),
+        ("profile_image_upload", upload_profile_image, OK),
+        ("group_members", lambda: ("GET", f"/group/{mentor()}", {"params": {"limit": 100}}), OK),
+        ("group_points", lambda: ("PUT", f"/group/{mentor()}/bucketlist/complete", {"params": {"points_added": 1}}), OK),
+        ("group_points_bulk", lambda: ("PUT", "/group/points/bulk", {"json": {
+            "awards": [{"mentor_name": mentor(), "points_added": 1} for _ in range(5)]
+        }}), OK),
+        ("bucketlist_get", lambda: ("GET", f"/bucketlist/{mentor()}/bucket_lists", {}), OK),
+        ("bucketlist_tasks", lambda: ("GET", f"/bucketlist/bucket_lists/{mentor()}", {}), OK),
+        ("bucketlist_all", lambda: ("GET", "/bucketlist/bucket_lists", {"params": {"limit": 20}}), OK),
+        ("bucketlist_add_task", add_task, OK),
+        ("bucketlist_toggle", toggle, OK),
+        ("bucketlist_delete_task", delete_task, OK),
+        ("leaderboard_users", lambda: ("GET", "/leaderboard/users", {"params": {"limit": 10}}), OK),
+        ("leaderboard_user_rank", lambda: ("GET", "/leaderboard/users/rank", {"params": {"email": student()}}), OK),
+        ("leaderboard_groups", lambda: ("GET", "/leaderboard/groups", {}), OK),
+        ("leaderboard_group_rank", lambda: ("GET", f"/leaderboard/groups/{mentor()}/rank", {}), OK),
+        ("images_get", lambda: ("GET", f"/images/{image()}", {}), OK),
+        ("images_get_thumbnail", lambda: ("GET", f"/images/{image()}", {"params": {"w": 64}, "headers": {"Accept": "image/webp"}}), OK),
+        ("images_get_range", lambda: ("GET", f"/images/{image()}", {"headers": {"Range": "bytes=0-1023"}}), (206,)),
+        ("images_not_modified", conditional_image, (304,)),
+        ("images_user_list", lambda: ("GET", f"/images/user/{rng.choice(data['images'])[1]}", {}), OK),
+        ("images_upload", upload_image, OK),
+        ("ready", lambda: ("GET", "/ready", {}), OK),
+        ("metrics_prometheus", lambda: ("GET", "/metrics", {}), OK),
+        ("metrics_storage", lambda: ("GET", "/metrics/storage", {}), OK),
+    ]
+
+def current_rss():
+    """
+    Resident memory in bytes right now (Linux), or the peak so far elsewhere
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+async def run_scenario(client, build, expect, requests: int, concurrency: int):
+    latencies = []
+    errors = 0
+    peak_rss = current_rss()
+    remaining = iter(range(requests))  # shared by every worker
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            method, url, kwargs = build()
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+                status = response.status_code
+            except Exception:
+                status = None
+            latencies.append(time.perf_counter() - start)
+            if status not in expect:
+                errors += 1
+
+    async def sample_memory():
+        nonlocal peak_rss
+        while True:
+            peak_rss = max(peak_rss, current_rss())
+            await asyncio.sleep(0.01)
+
+    sampler = asyncio.create_task(sample_memory())
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    sampler.cancel()
+    peak_rss = max(peak_rss, current_rss())
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "peak_rss_mb": round(peak_rss / (1024 * 1024), 1),
+    }
+
+def compare(results: dict, baseline: dict, threshold: float):
+    """
+    Everything that got slower (latency up or throughput down by more than
+    threshold) or started failing more often than in the baseline
+    """
+    regressions = []
+    for name, current in results.items():
+        before = baseline.get("endpoints", {}).get(name)
+        if not before:
+            continue
+        for metric in ("p50_ms", "p95_ms"):
+            if before[metric] > 0 and current[metric] > before[metric] * (1 + threshold):
+                regressions.append(f"{name}: {metric} {before[metric]} -> {current[metric]}")
+        if current["rps"] < before["rps"] * (1 - threshold):
+            regressions.append(f"{name}: rps {before['rps']} -> {current['rps']}")
+        if current["errors"] > before["errors"]:
+            regressions.append(f"{name}: errors {before['errors']} -> {current['errors']}")
+    return regressions
+
+def print_table(results: dict):
+    header = f"{'endpoint':<26}{'req':>6}{'err':>6}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'rss MB':>9}"
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        print(f"{name:<26}{r['requests']:>6}{r['errors']:>6}{r['rps']:>10}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}{r['peak_rss_mb']:>9}")
+
+async def main(args):
+    rng = random.Random(args.seed)
+    configure_environment(args)
+
+    # Only now, so the settings above are what the app sees
+    import httpx
+    import main as app_module
+    from database import db, client as mongo_client
+
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+
+    print(f"Seeding {'mongod at ' + args.mongo_uri if args.mongo_uri else 'the in-process fake'} "
+          f"({args.students} students, {args.groups} groups, {args.tasks} tasks each, {args.avatars} avatars)...")
+    with quiet:
+        data = await seed(args, db, rng)
+
+    transport = httpx.ASGITransport(app=app_module.app)
+    results = {}
+    async with app_module.lifespan(app_module.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=60) as client:
+            # ETags for the If-None-Match runs
+            for image_id, _ in data["images"][:50]:
+                response = await client.get(f"/images/{image_id}", headers={"Range": "bytes=0-0"})
+                data["etags"][image_id] = response.headers.get("etag", '"none"')
+
+            for name, build, expect in scenarios(data, rng):
+                if args.only and not any(name.startswith(prefix) for prefix in args.only):
+                    continue
+                with quiet:
+                    if args.warmup:
+                        await run_scenario(client, build, expect, args.warmup, min(args.concurrency, args.warmup))
+                    results[name] = await run_scenario(client, build, expect, args.requests, args.concurrency)
+                print(f"  {name}: {results[name]['p50_ms']} ms p50, {results[name]['errors']} errors")
+
+    if args.mongo_uri:
+        await mongo_client.drop_database(BENCHMARK_DATABASE)
+
+    print()
+    print_table(results)
+
+    report = {
+        "mode": "mongod" if args.mongo_uri else "fake",
+        "config": {key: getattr(args, key) for key in ("students", "groups", "tasks", "avatars", "requests", "concurrency", "bcrypt_rounds")},
+        "recorded_at": datetime.now(timezone.utc).isoformat(),
+        "endpoints": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved baseline to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("mode") != report["mode"] or baseline.get("config") != report["config"]:
+            print("\nWarning: baseline was recorded with a different mode or settings")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regressions beyond {args.threshold:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print(f"\nNo regressions beyond {args.threshold:.0%} against {args.baseline}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
@@ -1,66 +1,123 @@
-from fastapi import APIRouter, HTTPException, Body
-from uuid import uuid4
-from models import Task, BucketList
-from typing import List
+from fastapi import APIRouter, HTTPException, Body, Query, Request, Response
+from models import Task, BucketList, projection_for
+from typing import List, Optional
 from database import db
+from pagination import paginate, encode_cursor, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, NEXT_CURSOR_HEADER
+from task_store import tasks_collection, new_task, update_task_counts, TASK_SORT_KEYS
+from user_cache import get_user
+from points_ledger import points_ledger
+from mentors import mentor_directory
 
 bucketlist_router = APIRouter()
 
 # Collections
-users_collection = db["users"]
 bucketlist_collection = db["bucket_lists"]
 
+TASK_PROJECTION = {**projection_for(Task), "_id": 0}
+BUCKET_PROJECTION = {"mentor_name": 1, "task_count": 1, "completed_count": 1}
+
 # Helper function to get user and their role
 async def get_user_role(email: str):
-    user = await users_collection.find_one({"email": email})
+    user = await get_user(email)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return user.get("accountType", "student")
 
-# Get bucket list for mentor group
+# The id of the mentor a URL names. Every bucket list belongs to a mentor's account.
+async def require_mentor(mentor_name: str, detail: str = "Bucket list not found"):
+    mentor_id = await mentor_directory.resolve(mentor_name)
+    if mentor_id is None:
+        raise HTTPException(status_code=404, detail=detail)
+    return mentor_id
+
+# Get bucket list for mentor group, with its counters and the first page of tasks.
+# If there are more, X-Next-Cursor is set and works as ?after= on /bucket_lists/{mentor_name}
 @bucketlist_router.get("/{mentor_name}/bucket_lists", response_model=BucketList)
-async def get_bucketlist(mentor_name: str):
-    bucket = await bucketlist_collection.find_one({"mentor_name": mentor_name})
+async def get_bucketlist(mentor_name: str, response: Response):
+    mentor_id = await require_mentor(mentor_name)
+    bucket = await bucketlist_collection.find_one({"mentor_id": mentor_id}, BUCKET_PROJECTION)
     if not bucket:
         raise HTTPException(status_code=404, detail="Bucket list not found")
+    cursor = tasks_collection.find({"mentor_id": mentor_id}, TASK_PROJECTION)
+    # One extra task tells us whether there's another page
+    tasks = await cursor.sort([(key, 1) for key in TASK_SORT_KEYS]).to_list(DEFAULT_PAGE_SIZE + 1)
+    if len(tasks) > DEFAULT_PAGE_SIZE:
+        tasks = tasks[:DEFAULT_PAGE_SIZE]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor([tasks[-1].get(key) for key in TASK_SORT_KEYS])
+    bucket["tasks"] = tasks
     return bucket
 
-# Get all tasks in a bucket list
+# Get the tasks in a bucket list, a page at a time, optionally only open or completed ones
 @bucketlist_router.get("/bucket_lists/{mentor_name}", response_model=List[Task])
-async def get_bucketlist_tasks(mentor_name: str):
-    bucketlist = await bucketlist_collection.find_one({"mentor_name": mentor_name})
-    if not bucketlist:
+async def get_bucketlist_tasks(
+    request: Request,
+    mentor_name: str,
+    completed: Optional[bool] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+):
+    mentor_id = await mentor_directory.resolve(mentor_name)
+    if mentor_id is None:
         return []
-    return bucketlist.get("tasks", [])
+    query = {"mentor_id": mentor_id}
+    if completed is not None:
+        query["completed"] = completed
+    return await paginate(
+        request, tasks_collection, query,
+        limit=limit, after=after,
+        keys=TASK_SORT_KEYS,
+        projection=TASK_PROJECTION
+    )
 
-# View all bucketlists
+# View all bucketlists: counters only, tasks come from /bucket_lists/{mentor_name}
 @bucketlist_router.get("/bucket_lists", response_model=List[dict])
-async def get_all_bucketlists():
-    bucketlists = []
-    async for doc in bucketlist_collection.find():
-        doc["_id"] = str(doc["_id"])
-        bucketlists.append(doc)
-    return bucketlists
+async def get_all_bucketlists(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+):
+    return await paginate(request, bucketlist_collection, {}, limit=limit, after=after)
 
 # Add tasks (Mentors only)
 @bucketlist_router.post("/{mentor_name}/bucket_lists")
 async def add_task(mentor_name: str, task: Task, user_email: str):
     role = await get_user_role(user_email)
 
-    task.id = str(uuid4())  # Ensure task has a UUID
+    mentor_id = await require_mentor(mentor_name, "Mentor not found")
 
-    task_data = {
-        "id": task.id,
-        "description": task.description,
-        "completed": False
-    }
+    # Always a fresh UUID, whatever the client sent
+    await tasks_collection.insert_one(new_task(mentor_id, task.description))
+    # Creates the bucket list if this is its first task
+    await update_task_counts(mentor_id, tasks=1, mentor_name=mentor_directory.name_of(mentor_id) or mentor_name)
+    return {"message": "Task added"}
 
-    result = await bucketlist_collection.update_one(
-        {"mentor_name": mentor_name},
-        {"$push": {"tasks": task_data}},
-        upsert=True
+# 404 with the reason a task couldn't be found
+async def task_not_found(mentor_id):
+    bucket = await bucketlist_collection.find_one({"mentor_id": mentor_id}, {"_id": 1})
+    if not bucket:
+        raise HTTPException(status_code=404, detail="Bucket list not found")
+    raise HTTPException(status_code=404, detail="Task not found")
+
+# Atomically flip one task's completed flag, only if it isn't already in that state.
+# Returns True if the task was changed.
+async def set_task_completed(mentor_id, task_id: str, completed: bool):
+    result = await tasks_collection.update_one(
+        {"mentor_id": mentor_id, "id": task_id, "completed": not completed},
+        {"$set": {"completed": completed}}
     )
-    return {"message": "Task added"}
+    if result.modified_count > 0:
+        await update_task_counts(mentor_id, completed=1 if completed else -1)
+        return True
+
+    # Nothing changed, figure out why
+    if not await tasks_collection.find_one({"mentor_id": mentor_id, "id": task_id}, {"_id": 1}):
+        await task_not_found(mentor_id)
+    return False
+
+# Add points to the mentor and everyone in their group. Goes through the
+# ledger, which saves the award right away and batches the actual $incs.
+async def award_group_points(mentor_id, points_delta: int, task_id: str):
+    await points_ledger.award(mentor_id, points_delta, reason={"task_id": task_id})
 
 # Mark task complete and add points (Mentors only)
 @bucketlist_router.put("/{mentor_name}/bucket_lists/complete/{task_id}")
@@ -69,42 +126,12 @@ async def complete_task(mentor_name: str, task_id: str, user_email: str):
     if role != "Mentor":
         raise HTTPException(status_code=403, detail="Not authorized to complete tasks")
 
-    bucket = await bucketlist_collection.find_one({"mentor_name": mentor_name})
-    if not bucket:
-        raise HTTPException(status_code=404, detail="Bucket list not found")
-
-    tasks = bucket["tasks"]
-    found = False
-    for task in tasks:
-        if task["_id"] == task_id:
-            if task["completed"]:
-                return {"message": "Task already completed"}
-            task["completed"] = True
-            found = True
-            break
-
-    if not found:
-        raise HTTPException(status_code=404, detail="Task not found")
-
-    # Update the task list
-    await bucketlist_collection.update_one(
-        {"mentor_name": mentor_name},
-        {"$set": {"tasks": tasks}}
-    )
+    mentor_id = await require_mentor(mentor_name)
+    # Points only go out if this request is the one that completed the task
+    if not await set_task_completed(mentor_id, task_id, True):
+        return {"message": "Task already completed"}
 
-    # Update points for both the mentor and everyone in their group
-    
-    # Update points for the mentor (by fullName)
-    await users_collection.update_one(
-        {"fullName": mentor_name},
-        {"$inc": {"points": 10}}
-    )
-    
-    # Add 10 points to every member in the group
-    await users_collection.update_many(
-        {"mentor_name": mentor_name},
-        {"$inc": {"points": 10}}
-    )
+    await award_group_points(mentor_id, 10, task_id)
 
     return {"message": "Task marked complete and points awarded"}
 
@@ -116,81 +143,18 @@ async def toggle_task_completion(
     user_email: str,
     completed: bool = Body(..., embed=True)
 ):
-    # Print debug info
-    print(f"Toggle task: mentor={mentor_name}, task_id={task_id}, user={user_email}, completed={completed}")
-    
     role = await get_user_role(user_email)
-    print(f"User role: {role}")
     
     if role != "Mentor":
         raise HTTPException(status_code=403, detail="Not authorized to toggle tasks")
 
-    bucket = await bucketlist_collection.find_one({"mentor_name": mentor_name})
-    if not bucket:
-        raise HTTPException(status_code=404, detail="Bucket list not found")
-
-    print(f"Bucket found: {bucket['mentor_name']}, task count: {len(bucket.get('tasks', []))}")
-    
-    tasks = bucket.get("tasks", [])
-    print(f"Looking for task ID: {task_id}")
-    
-    # Debug the actual task structures to see all fields
-    for i, task in enumerate(tasks):
-        print(f"Task {i}: {task}")
-    
-    all_ids = []
-    for task in tasks:
-        # Check both id and task_id fields
-        task_id_value = None
-        if "id" in task:
-            task_id_value = task["id"]
-        elif "task_id" in task:
-            task_id_value = task["task_id"]
-        all_ids.append(task_id_value)
-    print(f"Available task IDs: {all_ids}")
-    
-    found = False
-    for task in tasks:
-        # Check for ID in both 'id' and 'task_id' fields
-        task_id_value = None
-        if "id" in task:
-            task_id_value = task["id"]
-        elif "task_id" in task:
-            task_id_value = task["task_id"]
-            
-        print(f"Checking task: {task_id_value} == {task_id}?")
-        
-        if task_id_value == task_id:
-            if task.get("completed", False) == completed:
-                return {"message": f"Task already {'completed' if completed else 'incomplete'}"}
-            task["completed"] = completed
-            found = True
-            print(f"Task found and updated: {task}")
-            break
-
-    if not found:
-        raise HTTPException(status_code=404, detail="Task not found")
-
-    # Update the task list
-    await bucketlist_collection.update_one(
-        {"mentor_name": mentor_name},
-        {"$set": {"tasks": tasks}}
-    )
+    mentor_id = await require_mentor(mentor_name)
+    if not await set_task_completed(mentor_id, task_id, completed):
+        return {"message": f"Task already {'completed' if completed else 'incomplete'}"}
 
     # Update points for both the mentor and everyone in their group
     points_delta = 10 if completed else -10
-    
-    # Update points for the mentor (by fullName)
-    await users_collection.update_one(
-        {"fullName": mentor_name},
-        {"$inc": {"points": points_delta}}
-    )
-    
-    # Update points for mentees in the group
-    await users_collection.update_many(
-        {"mentor_name": mentor_name},
-        {"$inc": {"points": points_delta}}
-    )
+    await award_group_points(mentor_id, points_delta, task_id)
 
     return {"message": f"Task marked {'complete' if completed else 'incomplete'} and points {'awarded' if completed else 'removed'}"}
 
@@ -201,35 +165,13 @@ async def delete_task(mentor_name: str, task_id: str, user_email: str):
     if role != "Mentor":
         raise HTTPException(status_code=403, detail="Not authorized to delete tasks")
     
-    bucket = await bucketlist_collection.find_one({"mentor_name": mentor_name})
-    if not bucket:
-        raise HTTPException(status_code=404, detail="Bucket list not found")
-    
-    # Filter out the task to be deleted, checking both 'id' and 'task_id' fields
-    tasks = bucket.get("tasks", [])
-    original_count = len(tasks)
-    
-    # Create a new list without the task to delete
-    new_tasks = []
-    for task in tasks:
-        # Check for ID in both 'id' and 'task_id' fields
-        task_id_value = None
-        if "id" in task:
-            task_id_value = task["id"]
-        elif "task_id" in task:
-            task_id_value = task["task_id"]
-            
-        if task_id_value != task_id:
-            new_tasks.append(task)
-    
-    # Check if any task was removed
-    if len(new_tasks) == original_count:
-        raise HTTPException(status_code=404, detail="Task not found")
-    
-    # Update the task list
-    await bucketlist_collection.update_one(
-        {"mentor_name": mentor_name},
-        {"$set": {"tasks": new_tasks}}
+    mentor_id = await require_mentor(mentor_name)
+    task = await tasks_collection.find_one_and_delete(
+        {"mentor_id": mentor_id, "id": task_id},
+        projection={"completed": 1}
     )
+    if task is None:
+        await task_not_found(mentor_id)
+    await update_task_counts(mentor_id, tasks=-1, completed=-1 if task.get("completed") else 0)
     
     return {"message": f"Task deleted successfully"}
@@ -0,0 +1,220 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+class ByteLRUCache:
+    """
+    Least-recently-used cache that's limited by the total size of what it holds
+    instead of the number of entries. Anything bigger than max_entry_bytes is
+    never cached so one large file can't push everything else out.
+    """
+
+    def __init__(self, max_bytes: int, max_entry_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (value, size)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, size: int):
+        """
+        Storing a value that takes up `size` bytes. Returns False if it was too big to cache.
+        """
+        if size > self.max_entry_bytes:
+            return False
+
+        self.invalidate(key)
+        self._entries[key] = (value, size)
+        self.current_bytes += size
+
+        # Dropping the least recently used entries until we're back under budget
+        while self.current_bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.current_bytes -= evicted_size
+            self.evictions += 1
+        return True
+
+    def invalidate(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry[1]
+
+    def clear(self):
+        self._entries.clear()
+        self.current_bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "max_entry_bytes": self.max_entry_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+class TTLCache:
+    """
+    Least-recently-used cache with a fixed number of entries that also expire
+    after ttl_seconds. Every invalidation bumps `generation`, so a slow load
+    that started before a write can tell its result is stale and skip storing it.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value, generation: int = None):
+        """
+        Storing a value. Pass the generation read before loading it to make
+        sure nothing was invalidated in the meantime. Returns False if skipped.
+        """
+        if generation is not None and generation != self.generation:
+            return False
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return True
+
+    def invalidate(self, key):
+        self.generation += 1
+        self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """
+        Dropping every entry whose value matches predicate(value)
+        """
+        self.generation += 1
+        for key in [key for key, (_, value) in self._entries.items() if predicate(value)]:
+            del self._entries[key]
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+class SingleFlight:
+    """
+    Makes concurrent calls for the same key share one in-flight load
+    instead of each hitting the database.
+    """
+
+    def __init__(self):
+        self.shared = 0  # calls that piggybacked on someone else's load
+        self._calls = {}
+
+    async def run(self, key, load):
+        future = self._calls.get(key)
+        if future is not None:
+            self.shared += 1
+        else:
+            future = asyncio.ensure_future(load())
+            self._calls[key] = future
+            future.add_done_callback(lambda _: self._forget(key, future))
+        # shield so one caller giving up doesn't cancel the load for everyone else
+        return await asyncio.shield(future)
+
+    def _forget(self, key, future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+class StaleWhileRevalidate:
+    """
+    Holds the result of one expensive async load. It's served as is for
+    ttl_seconds; after that, for up to stale_seconds more, the old value is
+    still returned right away while a refresh runs in the background. Past
+    that (or the first time) callers wait for the load. Concurrent loads are
+    shared, and a failed background refresh keeps the old value.
+    """
+
+    def __init__(self, load, ttl_seconds: float, stale_seconds: float = 0):
+        self.load = load
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.value = None
+        self.loaded_at = None
+        self.refreshes = 0
+        self.failures = 0
+        self._loads = SingleFlight()
+        self._background = None
+
+    def age(self):
+        return None if self.loaded_at is None else time.monotonic() - self.loaded_at
+
+    async def _refresh(self):
+        try:
+            value = await self.load()
+        except Exception:
+            self.failures += 1
+            raise
+        self.value = value
+        self.loaded_at = time.monotonic()
+        self.refreshes += 1
+        return value
+
+    async def get(self):
+        age = self.age()
+        if age is not None and age < self.ttl_seconds:
+            return self.value
+        if age is not None and age < self.ttl_seconds + self.stale_seconds:
+            if self._background is None or self._background.done():
+                self._background = asyncio.ensure_future(self._refresh_quietly())
+            return self.value
+        return await self._loads.run("load", self._refresh)
+
+    async def _refresh_quietly(self):
+        try:
+            await self._loads.run("load", self._refresh)
+        except Exception as e:
+            print(f"Background refresh failed, keeping the old value: {e}")
+
+    def invalidate(self):
+        self.loaded_at = None
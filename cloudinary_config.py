@@ -10,4 +10,13 @@ cloudinary.config(
     cloud_name=os.getenv("CLOUDINARY_CLOUD_NAME"),
     api_key=os.getenv("CLOUDINARY_API_KEY"),
     api_secret=os.getenv("CLOUDINARY_API_SECRET")
-)
\ No newline at end of file
+)
+
+def cloudinary_configured():
+    config = cloudinary.config()
+    return bool(
+        config.cloud_name and
+        config.api_key and
+        config.api_secret and
+        config.cloud_name != "your_cloud_name"
+    )
@@ -0,0 +1,103 @@
+import gzip
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is used when it isn't installed
+    brotli = None
+
+# Already compressed (images) or streamed as it's produced (NDJSON, SSE)
+EXCLUDED_CONTENT_TYPES = ("image/", "application/x-ndjson", "text/event-stream")
+
+class CompressionMiddleware:
+    """
+    Compresses complete responses with brotli or gzip, whichever the client
+    prefers in Accept-Encoding. Small bodies, streamed bodies, partial content
+    and images are passed through untouched.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # Even with no encoding to use, responses still need Vary (below)
+        encoding = self.choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+
+        start_message = None
+        body_started = False
+
+        async def compressing_send(message):
+            nonlocal start_message, body_started
+            if message["type"] == "http.response.start":
+                # Hold the headers back until we've seen the body
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or body_started:
+                await send(message)
+                return
+
+            body_started = True
+            body = message.get("body", b"")
+            headers = MutableHeaders(scope=start_message)
+            if self.is_compressible(start_message["status"], headers):
+                # Another client could get a different encoding of this, so caches
+                # must not hand this one out to everyone, compressed or not
+                headers.add_vary_header("Accept-Encoding")
+            if encoding is None or message.get("more_body", False) or not self.should_compress(start_message["status"], headers, len(body)):
+                await send(start_message)
+                await send(message)
+                return
+
+            compressed = self.compress(encoding, body)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            await send(start_message)
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, compressing_send)
+
+    def choose_encoding(self, accept_encoding: str):
+        accepted = {}
+        for part in accept_encoding.split(","):
+            name, _, params = part.strip().partition(";")
+            quality = 1.0
+            params = params.strip()
+            if params.startswith("q="):
+                try:
+                    quality = float(params[2:])
+                except ValueError:
+                    quality = 0.0
+            if name:
+                accepted[name.strip().lower()] = quality
+
+        # Highest q wins; brotli comes first so it wins ties
+        supported = ("br", "gzip") if brotli is not None else ("gzip",)
+        best, best_quality = None, 0.0
+        for name in supported:
+            quality = accepted.get(name, accepted.get("*", 0.0))
+            if quality > best_quality:
+                best, best_quality = name, quality
+        return best
+
+    def should_compress(self, status: int, headers: MutableHeaders, size: int):
+        return size >= self.minimum_size and self.is_compressible(status, headers)
+
+    def is_compressible(self, status: int, headers: MutableHeaders):
+        if status in (204, 206, 304):
+            return False
+        if "content-encoding" in headers:
+            return False
+        content_type = headers.get("content-type", "")
+        return not content_type.startswith(EXCLUDED_CONTENT_TYPES)
+
+    def compress(self, encoding: str, body: bytes):
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level)
@@ -3,47 +3,320 @@ from pydantic import BaseModel, Field
 from motor.motor_asyncio import AsyncIOMotorClient
 from typing import Dict, List
 from bson import ObjectId
+import asyncio
 import os
 from dotenv import load_dotenv
 from models import Profile, ProfileOut, UpdateProfile
-from pymongo import ReturnDocument
+from pymongo import ReturnDocument, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from metrics import mongo_listener, pool_listener
+from cache import StaleWhileRevalidate
 
 # Load environment variables from .env file
 load_dotenv()
 MONGODB_URI = os.getenv("MONGODB_URI")
 
+# Connection pool settings. Anything left unset keeps the driver's default.
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+MONGO_CLIENT_SETTINGS = {
+    # env var -> (client option, type)
+    "MONGO_MAX_IDLE_TIME_MS": ("maxIdleTimeMS", int),
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": ("waitQueueTimeoutMS", int),
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": ("serverSelectionTimeoutMS", int),
+    "MONGO_CONNECT_TIMEOUT_MS": ("connectTimeoutMS", int),
+    "MONGO_SOCKET_TIMEOUT_MS": ("socketTimeoutMS", int),
+    "MONGO_READ_PREFERENCE": ("readPreference", str),
+}
+
+# Wire compressors in order of preference. zstd and snappy need extra packages,
+# so only the ones that are installed get offered to the server.
+COMPRESSOR_MODULES = {"zstd": "zstandard", "snappy": "snappy", "zlib": "zlib"}
+DEFAULT_COMPRESSORS = "zstd,snappy,zlib"
+
+def available_compressors(requested: str, warn: bool = True):
+    compressors = []
+    for name in [name.strip() for name in requested.split(",") if name.strip()]:
+        module = COMPRESSOR_MODULES.get(name)
+        if module is None:
+            print(f"Unknown Mongo compressor {name}, skipping it")
+            continue
+        try:
+            __import__(module)
+        except ImportError:
+            if warn:
+                print(f"Mongo compressor {name} needs the {module} package, skipping it")
+            continue
+        compressors.append(name)
+    return compressors
+
+def client_options():
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "tlsAllowInvalidCertificates": True,
+    }
+    for env_name, (option, cast) in MONGO_CLIENT_SETTINGS.items():
+        value = os.getenv(env_name)
+        if value:
+            options[option] = cast(value)
+    requested = os.getenv("MONGO_COMPRESSORS")
+    # Only complain about missing packages when someone asked for them
+    compressors = available_compressors(requested or DEFAULT_COMPRESSORS, warn=bool(requested))
+    if compressors:
+        options["compressors"] = ",".join(compressors)
+    return options
+
+def create_client(uri: str = None, **overrides):
+    """
+    Building a Motor client from the MONGO_* settings. Nothing connects until
+    the first operation (or open_database()).
+    """
+    options = {**client_options(), **overrides}
+    # command and pool metrics for /metrics
+    return AsyncIOMotorClient(uri or MONGODB_URI, event_listeners=[mongo_listener, pool_listener], **options)
+
 # MongoDB connection
-client = AsyncIOMotorClient(MONGODB_URI, tlsAllowInvalidCertificates=True)
-db = client["bootcamp"]
+client = create_client()
+# MONGODB_DATABASE lets scripts like benchmark.py work in a throwaway database
+db = client[os.getenv("MONGODB_DATABASE", "bootcamp")]
+
+async def open_database():
+    """
+    Connecting on startup instead of on the first request: checks the server
+    answers, then opens MONGO_MIN_POOL_SIZE connections so the first burst of
+    requests doesn't pay for the handshakes.
+    """
+    await client.admin.command("ping")
+    if MONGO_MIN_POOL_SIZE > 1:
+        # Pings running at the same time each need their own connection
+        await asyncio.gather(*[client.admin.command("ping") for _ in range(MONGO_MIN_POOL_SIZE)])
+    print(f"Connected to MongoDB (pool {MONGO_MIN_POOL_SIZE}-{MONGO_MAX_POOL_SIZE} connections)")
+
+def close_database():
+    client.close()
+
+# Every index the routers rely on, by collection. Each entry is the key pattern
+# plus any create_index options, so adding a new query path is just a new line here.
+INDEXES = {
+    "users": [
+        # signup/login/profile lookups. Signup relies on it to reject duplicate
+        # emails, so the app won't start without it.
+        {"keys": [("email", ASCENDING)], "name": "email_unique", "unique": True, "required": True},
+        {"keys": [("mentor_id", ASCENDING), ("_id", ASCENDING)], "name": "mentor_id_id"},  # group members, paged
+        {"keys": [("mentor_name", ASCENDING), ("_id", ASCENDING)], "name": "mentor_name_id"},  # students whose mentor hasn't signed up
+        {"keys": [("accountType", ASCENDING), ("_id", ASCENDING)], "name": "accountType_id"},  # get_by_role, paged
+        {"keys": [("fullName", ASCENDING)], "name": "fullName"},  # mentor directory lookups
+        {"keys": [("previous_names", ASCENDING)], "name": "previous_names"},  # mentors' old names
+        {"keys": [("points", DESCENDING)], "name": "points_desc"},  # leaderboard
+        {"keys": [("accountType", ASCENDING), ("points", DESCENDING)], "name": "accountType_points_desc"},
+    ],
+    "bucket_lists": [
+        {"keys": [("mentor_id", ASCENDING)], "name": "mentor_id"},
+        {"keys": [("mentor_name", ASCENDING)], "name": "mentor_name"},
+    ],
+    "tasks": [
+        # a list's tasks, open or completed, paged oldest first
+        {
+            "keys": [("mentor_id", ASCENDING), ("completed", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)],
+            "name": "mentor_id_completed_created_at_id",
+        },
+        # all of a list's tasks, paged oldest first
+        {"keys": [("mentor_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], "name": "mentor_id_created_at_id"},
+        # toggle/delete by task id
+        {"keys": [("id", ASCENDING), ("mentor_id", ASCENDING)], "name": "id_mentor_id", "unique": True},
+    ],
+    "group_totals": [
+        {"keys": [("total_points", DESCENDING)], "name": "total_points_desc"},  # group leaderboard
+    ],
+    "fs.files": [
+        {"keys": [("metadata.user_id", ASCENDING), ("_id", ASCENDING)], "name": "metadata_user_id_id"},  # images per user, paged
+        # one stored derivative per (original, width, format); only variants have metadata.variant_of
+        {
+            "keys": [("metadata.variant_of", ASCENDING), ("metadata.width", ASCENDING), ("metadata.format", ASCENDING)],
+            "name": "metadata_variant_of_width_format",
+            "unique": True,
+            "partialFilterExpression": {"metadata.variant_of": {"$exists": True}},
+        },
+        # finding an existing blob with the same content. Not unique: two uploads of the same
+        # new image racing each other can both store it, which only costs a little space
+        {"keys": [("sha256", ASCENDING)], "name": "sha256"},
+    ],
+    "images": [
+        {"keys": [("metadata.user_id", ASCENDING), ("_id", ASCENDING)], "name": "metadata_user_id_id"},  # images per user, paged
+        {"keys": [("blob_id", ASCENDING)], "name": "blob_id"},
+    ],
+    "points_events": [
+        {"keys": [("batch_id", ASCENDING)], "name": "batch_id"},  # applying a flushed batch
+        {"keys": [("applied_at", ASCENDING), ("created_at", ASCENDING)], "name": "applied_at_created_at"},  # outbox on startup
+    ],
+    "fs.chunks": [
+        {"keys": [("files_id", ASCENDING), ("n", ASCENDING)], "name": "files_id_n", "unique": True},
+    ],
+}
+
+def _key_pattern(keys):
+    return tuple((field, int(direction)) for field, direction in keys)
+
+def _index_matches(index: dict, spec: dict):
+    """
+    Whether a live index does the job of a spec: same keys, and the same
+    uniqueness and partial filter (a plain index on email doesn't stop duplicates)
+    """
+    return (
+        _key_pattern(index["key"].items()) == _key_pattern(spec["keys"])
+        and bool(index.get("unique")) == bool(spec.get("unique"))
+        and index.get("partialFilterExpression") == spec.get("partialFilterExpression")
+    )
+
+async def _live_indexes(collection):
+    return [index async for index in collection.list_indexes()]
+
+async def ensure_indexes():
+    """
+    Create every index in INDEXES that isn't there yet. Runs on startup.
+    A failure on one index is reported but doesn't stop the app from booting,
+    unless the index is marked required (e.g. duplicate emails blocking the
+    unique email index), since then the app would quietly misbehave.
+    """
+    missing_required = []
+    for collection_name, specs in INDEXES.items():
+        collection = db[collection_name]
+        existing = await _live_indexes(collection)
+
+        for spec in specs:
+            if any(_index_matches(index, spec) for index in existing):
+                continue
+            options = {k: v for k, v in spec.items() if k not in ("keys", "required")}
+            try:
+                await collection.create_index(spec["keys"], **options)
+                print(f"Created index {spec['name']} on {collection_name}")
+            except OperationFailure as e:
+                # Also what happens when an index on the same keys exists with other options
+                print(f"Could not create index {spec['name']} on {collection_name}: {e}")
+                if spec.get("required"):
+                    missing_required.append(f"{collection_name}.{spec['name']}")
+
+    if missing_required:
+        raise RuntimeError(
+            f"Required indexes missing: {', '.join(missing_required)}. "
+            "Fix the data (or drop the conflicting index) and restart."
+        )
+
+async def check_indexes():
+    """
+    Compare the live indexes against INDEXES. Reports registry indexes that are
+    missing and live indexes that haven't been used since the server started.
+    """
+    missing = []
+    unused = []
+    collections = await db.list_collection_names()
+    for collection_name, specs in INDEXES.items():
+        if collection_name not in collections:
+            missing.extend(f"{collection_name}.{spec['name']}" for spec in specs)
+            continue
+
+        collection = db[collection_name]
+        existing = await _live_indexes(collection)
+        for spec in specs:
+            if not any(_index_matches(index, spec) for index in existing):
+                missing.append(f"{collection_name}.{spec['name']}")
+
+        try:
+            async for stats in collection.aggregate([{"$indexStats": {}}]):
+                if stats["name"] != "_id_" and stats["accesses"]["ops"] == 0:
+                    unused.append(f"{collection_name}.{stats['name']}")
+        except OperationFailure as e:
+            # $indexStats needs clusterMonitor on some hosted deployments
+            print(f"Could not read index stats for {collection_name}: {e}")
+
+    return {"missing": missing, "unused": unused}
+
+async def collection_stats(name: str):
+    """
+    Size numbers for one collection, for capacity planning
+    """
+    stats = await db.command("collStats", name)
+    return {
+        "count": stats.get("count", 0),
+        "size": stats.get("size", 0),
+        "storage_size": stats.get("storageSize", 0),
+        "avg_obj_size": stats.get("avgObjSize", 0),
+        "indexes": stats.get("nindexes", 0),
+        "index_size": stats.get("totalIndexSize", 0),
+    }
+
+# Other modules' expensive storage numbers, by the key they show up under in
+# /metrics/storage. Each is an async function, run (and cached) with the rest.
+storage_collectors = {}
+
+async def collect_storage_metrics():
+    """
+    Running every stats command at once instead of one after the other
+    """
+    collections = sorted(await db.list_collection_names())
+    extra_names = list(storage_collectors)
+    db_stats, index_report, *results = await asyncio.gather(
+        db.command("dbStats"),
+        check_indexes(),
+        *[storage_collectors[name]() for name in extra_names],
+        *[collection_stats(name) for name in collections],
+        return_exceptions=True
+    )
+    extras, per_collection = results[:len(extra_names)], results[len(extra_names):]
+    if isinstance(db_stats, Exception):
+        raise db_stats
+    if isinstance(index_report, Exception):
+        print(f"Could not check indexes: {index_report}")
+        index_report = None
+
+    breakdown = {}
+    for name, stats in zip(collections, per_collection):
+        if isinstance(stats, Exception):
+            # Views and system collections can't be asked for collStats
+            print(f"Could not get stats for {name}: {stats}")
+            continue
+        breakdown[name] = stats
+
+    empty = {"count": 0, "size": 0}
+    metrics = {
+        "database_size": db_stats["dataSize"],
+        "storage_size": db_stats["storageSize"],
+        "indexes": db_stats["indexes"],
+        "index_size": db_stats.get("indexSize", 0),
+        "has_gridfs": "fs.files" in collections and "fs.chunks" in collections,
+        "collections": collections,
+        "collection_stats": breakdown,
+        "fs_files": {key: breakdown.get("fs.files", empty)[key] for key in empty},
+        "fs_chunks": {key: breakdown.get("fs.chunks", empty)[key] for key in empty},
+        "index_report": index_report,
+    }
+    for name, value in zip(extra_names, extras):
+        if isinstance(value, Exception):
+            print(f"Could not collect {name}: {value}")
+            value = None
+        metrics[name] = value
+    return metrics
+
+# Monitoring scrapes this every few seconds, so the stats commands only run once
+# per STORAGE_METRICS_TTL_SECONDS. For STORAGE_METRICS_STALE_SECONDS after that the
+# old numbers are still served while fresh ones are fetched in the background.
+storage_metrics = StaleWhileRevalidate(
+    collect_storage_metrics,
+    ttl_seconds=float(os.getenv("STORAGE_METRICS_TTL_SECONDS", 60)),
+    stale_seconds=float(os.getenv("STORAGE_METRICS_STALE_SECONDS", 300)),
+)
 
 async def check_storage_metrics():
     try:
-        # Get database stats
-        db_stats = await db.command("dbStats")
-        
-        # Check if GridFS collections exist
-        collections = await db.list_collection_names()
-        has_gridfs = "fs.files" in collections and "fs.chunks" in collections
-        
-        # Get collection stats for fs collections if they exist
-        fs_files_stats = await db.fs.files.stats() if "fs.files" in collections else {"count": 0, "size": 0}
-        fs_chunks_stats = await db.fs.chunks.stats() if "fs.chunks" in collections else {"count": 0, "size": 0}
-        
-        return {
-            "database_size": db_stats["dataSize"],
-            "storage_size": db_stats["storageSize"],
-            "indexes": db_stats["indexes"],
-            "has_gridfs": has_gridfs,
-            "collections": collections,
-            "fs_files": {
-                "count": fs_files_stats["count"],
-                "size": fs_files_stats["size"]
-            },
-            "fs_chunks": {
-                "count": fs_chunks_stats["count"],
-                "size": fs_chunks_stats["size"]
-            }
-        }
+        # A copy, callers add their own live numbers to it
+        metrics = dict(await storage_metrics.get())
+        metrics["age_seconds"] = round(storage_metrics.age() or 0, 1)
+
+        # imported here since image_gc needs this module's db
+        from image_gc import image_gc
+        metrics["image_gc"] = image_gc.stats()
+        return metrics
     except Exception as e:
         print(f"Error checking storage metrics: {e}")
-        return None
\ No newline at end of file
+        return None
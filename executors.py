@@ -0,0 +1,70 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+class ExecutorSaturated(Exception):
+    """
+    Raised when a pool already has as much work waiting as we allow
+    """
+
+class BoundedExecutor:
+    """
+    Worker pool for CPU-heavy work (password hashing, image resizing) that
+    keeps it off the event loop. At most max_workers jobs run at once and at
+    most max_queue more can wait; anything past that is rejected right away
+    so callers can send back a 503 instead of piling up.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int, processes: bool = False):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.processes = processes
+        self.pending = 0  # running + waiting
+        self.completed = 0
+        self.rejected = 0
+        self._executor = None
+        executors[name] = self
+
+    @property
+    def executor(self):
+        # Created on first use so importing a module never starts processes
+        if self._executor is None:
+            if self.processes:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+        return self._executor
+
+    async def run(self, fn, *args):
+        if self.pending >= self.max_workers + self.max_queue:
+            self.rejected += 1
+            raise ExecutorSaturated(f"{self.name} pool is saturated")
+
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self):
+        return {
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "in_flight": min(self.pending, self.max_workers),
+            "queued": max(self.pending - self.max_workers, 0),
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+# Every pool by name, so metrics and shutdown can find them
+executors = {}
+
+def shutdown_executors():
+    for pool in executors.values():
+        pool.shutdown()
@@ -1,7 +1,14 @@
-from fastapi import FastAPI, APIRouter, HTTPException
-from models import ProfileOut
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Request
+from models import ProfileOut, BulkPointsAward, PROFILE_PROJECTION
 from database import db
-from typing import List
+from leaderboard import record_group_points, record_many_group_points, group_key
+from pagination import paginate, MAX_PAGE_SIZE
+from user_cache import invalidate_group
+from mentors import mentor_directory, group_filter
+from points_ledger import points_ledger
+from typing import List, Optional
+from pymongo import UpdateMany
+from pymongo.errors import BulkWriteError
 
 group_router = APIRouter()
 
@@ -10,36 +17,102 @@ users_collection = db["users"]
 
 # GET LIST OF USERS FOR SAME MENTOR
 @group_router.get("/{mentor_name}", response_model=List[ProfileOut])
-async def get_members(mentor_name:str):
-    cursor = users_collection.find({"mentor_name": mentor_name})
-    
-    if not cursor:
-        raise HTTPException(status_code=404, detail="Mentor not found")
-    
-    members = []
-    async for doc in cursor:
-        doc["_id"] = str(doc["_id"]) # convert ObjectId to string for response
-        members.append(doc)
-    return members
+async def get_members(
+    mentor_name: str,
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+):
+    # one page at a time, walking the (mentor_id, _id) index
+    mentor_id = await mentor_directory.resolve(mentor_name)
+    return await paginate(
+        request, users_collection,
+        group_filter(mentor_name, mentor_id),
+        limit=limit, after=after,
+        projection=PROFILE_PROJECTION,
+        transform=points_ledger.with_pending
+    )
 
 # UPDATE POINT TOTALS FOR GROUP
 # change the URL thing after bucketlist backend is complete
 @group_router.put("/{mentor_name}/bucketlist/complete")
 async def update_points(mentor_name:str, points_added:int):
-    members = users_collection.find({"mentor_name": mentor_name})
-    updated = 0
-
-    # use async for loop since cursor returned by .find is async
-    async for member in members:
-        result = await users_collection.update_one(
-            {"_id": member["_id"]},
-            {"$inc": {"points": points_added}}
-        )
-
-        # increment updated var if number of docs modified > 0
-        if result.modified_count > 0:
-            updated += 1
-    
-    if updated == 0:
+    # one server-side update for the whole group instead of one per member
+    mentor_id = await mentor_directory.resolve(mentor_name)
+    result = await users_collection.update_many(
+        group_filter(mentor_name, mentor_id),
+        {"$inc": {"points": points_added}}
+    )
+
+    if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="No members updated")
-    return {"message": "Updated group points"}
\ No newline at end of file
+    await record_group_points(group_key(mentor_name, mentor_id), points_added, result.modified_count)
+    # an old name still resolves after a rename, but cached members have the current one
+    invalidate_group(mentor_directory.name_of(mentor_id) or mentor_name)
+    return {"message": "Updated group points"}
+
+# UPDATE POINT TOTALS FOR MANY GROUPS AT ONCE
+@group_router.put("/points/bulk")
+async def bulk_update_points(award: BulkPointsAward):
+    if not award.awards:
+        raise HTTPException(status_code=400, detail="No awards given")
+
+    # bulk_write only reports totals, so count each group's members first (one query)
+    # to report per-group numbers. $inc with a non-zero delta always modifies.
+    mentor_ids = await mentor_directory.resolve_many(a.mentor_name for a in award.awards)
+    filters = {name: group_filter(name, mentor_id) for name, mentor_id in mentor_ids.items()}
+    group_names = {name: mentor_directory.name_of(mentor_id) or name for name, mentor_id in mentor_ids.items()}
+    member_counts = {}
+    async for doc in users_collection.aggregate([
+        {"$match": {"$or": list(filters.values())}},
+        # mentees of a mentor with an account by id, the rest by name
+        {"$group": {"_id": {"$ifNull": ["$mentor_id", "$mentor_name"]}, "count": {"$sum": 1}}}
+    ]):
+        member_counts[doc["_id"]] = doc["count"]
+
+    operations = [
+        UpdateMany(filters[a.mentor_name], {"$inc": {"points": a.points_added}})
+        for a in award.awards
+    ]
+
+    failed = {}
+    try:
+        result = await users_collection.bulk_write(operations, ordered=award.ordered)
+        matched, modified = result.matched_count, result.modified_count
+    except BulkWriteError as e:
+        details = e.details
+        matched, modified = details.get("nMatched", 0), details.get("nModified", 0)
+        for error in details.get("writeErrors", []):
+            failed[error["index"]] = error.get("errmsg", "Write failed")
+
+    # in ordered mode nothing after the first failure was applied
+    first_failure = min(failed) if failed and award.ordered else None
+
+    groups = []
+    for index, a in enumerate(award.awards):
+        group_result = {"mentor_name": a.mentor_name, "points_added": a.points_added}
+        if index in failed:
+            group_result.update({"matched": 0, "modified": 0, "error": failed[index]})
+        elif first_failure is not None and index > first_failure:
+            group_result.update({"matched": 0, "modified": 0, "error": "Not applied"})
+        else:
+            count = member_counts.get(mentor_ids[a.mentor_name] or a.mentor_name, 0)
+            group_result.update({"matched": count, "modified": count if a.points_added else 0})
+        groups.append(group_result)
+
+    # keep the leaderboard totals in step, again in a single round trip
+    deltas = {}
+    for g in groups:
+        group = group_key(g["mentor_name"], mentor_ids[g["mentor_name"]])
+        deltas[group] = deltas.get(group, 0) + g["points_added"] * g["modified"]
+    await record_many_group_points(deltas)
+    # (cached members have each group's current name, whatever name the request used)
+    for name in {group_names[g["mentor_name"]] for g in groups}:
+        invalidate_group(name)
+
+    return {
+        "message": "Updated group points",
+        "matched": matched,
+        "modified": modified,
+        "groups": groups
+    }
@@ -0,0 +1,256 @@
+import asyncio
+import os
+import re
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from database import db
+from image_records import images_collection, image_records, delete_blob, remove_image
+from image_store import image_cache
+from image_variants import delete_variants
+
+# Pulling the image id out of a profile_pic URL like "/images/<id>" or "/images/<id>?w=64"
+IMAGE_URL_ID = re.compile(r"/images/([0-9a-fA-F]{24})")
+
+async def referenced_image_ids():
+    """
+    Every image id a user points at. Newer profiles keep a "/images/<id>" URL in
+    profile_pic, older ones a bare id in profile_picture.
+    """
+    ids = set()
+    cursor = db.users.find(
+        {"$or": [{"profile_pic": {"$regex": "/images/"}}, {"profile_picture": {"$exists": True}}]},
+        {"profile_pic": 1, "profile_picture": 1}
+    )
+    async for user in cursor:
+        match = IMAGE_URL_ID.search(user.get("profile_pic") or "")
+        if match:
+            ids.add(ObjectId(match.group(1)))
+        legacy_id = user.get("profile_picture")
+        if isinstance(legacy_id, str) and ObjectId.is_valid(legacy_id):
+            ids.add(ObjectId(legacy_id))
+    return ids
+
+def _batches(items, size):
+    for offset in range(0, len(items), size):
+        yield items[offset:offset + size]
+
+class ImageCollector:
+    """
+    Mark-and-sweep garbage collection for stored images. Marks every image a
+    user points at, then sweeps (in small batches with a pause in between so
+    it never hogs the database):
+
+    - profile pictures nobody uses anymore (replaced avatars)
+    - blobs no image record points at (e.g. the app died between the two writes)
+    - resized variants whose original is gone
+    - chunks with no fs.files row (uploads that failed part way)
+    - fs.files rows with no chunks
+
+    Nothing younger than grace_seconds is touched, so uploads in progress are
+    safe. A dry run reports what would go without deleting anything.
+    """
+
+    def __init__(self, interval_seconds: float = 6 * 3600, grace_seconds: float = 24 * 3600,
+                 batch_size: int = 100, batch_pause: float = 0.5):
+        self.interval_seconds = interval_seconds
+        self.grace_seconds = grace_seconds
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.runs = 0
+        self.total_reclaimed_bytes = 0
+        self.last_report = None
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def running(self):
+        return self._lock.locked()
+
+    async def run(self, dry_run: bool = False, grace_seconds: float = None):
+        async with self._lock:
+            grace = self.grace_seconds if grace_seconds is None else grace_seconds
+            # Ids are ObjectIds made when the document was written, so they tell us its
+            # age even for the oldest fs.files rows (and their records), which have no uploadDate
+            cutoff = ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(seconds=grace))
+            report = {
+                "dry_run": dry_run,
+                "grace_seconds": grace,
+                "started_at": datetime.now(timezone.utc).isoformat(),
+            }
+            report["stale_profile_pictures"] = await self._sweep_profile_pictures(cutoff, dry_run)
+            report["unreferenced_blobs"] = await self._sweep_unreferenced_blobs(cutoff, dry_run)
+            report["orphan_variants"] = await self._sweep_orphan_variants(cutoff, dry_run)
+            report["orphan_chunks"] = await self._sweep_orphan_chunks(cutoff, dry_run)
+            report["dangling_files"] = await self._sweep_dangling_files(cutoff, dry_run)
+            report["reclaimed_bytes"] = sum(
+                value["bytes"] for value in report.values() if isinstance(value, dict)
+            )
+            report["finished_at"] = datetime.now(timezone.utc).isoformat()
+
+            print(f"Image GC ({'dry run' if dry_run else 'sweep'}): {report['reclaimed_bytes']} bytes reclaimable")
+            if not dry_run:
+                self.runs += 1
+                self.total_reclaimed_bytes += report["reclaimed_bytes"]
+                self.last_report = report
+            return report
+
+    async def _pause(self):
+        if self.batch_pause:
+            await asyncio.sleep(self.batch_pause)
+
+    async def _sweep_profile_pictures(self, cutoff, dry_run):
+        referenced = await referenced_image_ids()
+        stale = [
+            record async for record in images_collection.find(
+                {"metadata.is_profile_picture": True, "_id": {"$lt": cutoff}},
+                {"blob_id": 1}
+            )
+            if record["_id"] not in referenced
+        ]
+
+        freed_bytes = 0
+        for batch in _batches(stale, self.batch_size):
+            # A blob only gets freed if every image sharing it is going too
+            references = {}
+            for record in batch:
+                references[record["blob_id"]] = references.get(record["blob_id"], 0) + 1
+            async for blob in db.fs.files.find({"_id": {"$in": list(references)}}, {"length": 1, "refcount": 1}):
+                if references[blob["_id"]] >= blob.get("refcount", 1):
+                    freed_bytes += blob.get("length", 0)
+
+            if not dry_run:
+                for record in batch:
+                    await remove_image(record["_id"])
+            await self._pause()
+        return {"count": len(stale), "bytes": freed_bytes}
+
+    async def _sweep_unreferenced_blobs(self, cutoff, dry_run):
+        blobs = [
+            blob async for blob in db.fs.files.find(
+                {"refcount": {"$exists": True}, "_id": {"$lt": cutoff}, "metadata.variant_of": {"$exists": False}},
+                {"length": 1, "refcount": 1}
+            )
+        ]
+
+        count = freed_bytes = 0
+        for batch in _batches(blobs, self.batch_size):
+            in_use = set(await images_collection.distinct("blob_id", {"blob_id": {"$in": [blob["_id"] for blob in batch]}}))
+            for blob in batch:
+                if blob["_id"] in in_use:
+                    continue
+                if not dry_run:
+                    # Only if no upload has started sharing it since we looked
+                    result = await db.fs.files.update_one(
+                        {"_id": blob["_id"], "refcount": blob["refcount"]},
+                        {"$set": {"refcount": 0}}
+                    )
+                    if result.modified_count == 0 or not await delete_blob(blob["_id"]):
+                        continue
+                count += 1
+                freed_bytes += blob.get("length", 0)
+            await self._pause()
+        return {"count": count, "bytes": freed_bytes}
+
+    async def _sweep_orphan_variants(self, cutoff, dry_run):
+        variants = [
+            variant async for variant in db.fs.files.find(
+                {"metadata.variant_of": {"$exists": True}, "_id": {"$lt": cutoff}},
+                {"length": 1, "metadata.variant_of": 1}
+            )
+        ]
+
+        count = freed_bytes = 0
+        for batch in _batches(variants, self.batch_size):
+            parent_ids = list({variant["metadata"]["variant_of"] for variant in batch})
+            existing = set(await db.fs.files.distinct("_id", {"_id": {"$in": parent_ids}}))
+            orphans = [variant for variant in batch if variant["metadata"]["variant_of"] not in existing]
+            if orphans and not dry_run:
+                for parent_id in {variant["metadata"]["variant_of"] for variant in orphans}:
+                    await delete_variants(parent_id)
+            count += len(orphans)
+            freed_bytes += sum(variant.get("length", 0) for variant in orphans)
+            await self._pause()
+        return {"count": count, "bytes": freed_bytes}
+
+    async def _sweep_orphan_chunks(self, cutoff, dry_run):
+        # Sorting first lets Mongo walk the files_id_n index instead of every chunk
+        files_ids = [
+            row["_id"] async for row in db.fs.chunks.aggregate([
+                {"$sort": {"files_id": 1}},
+                {"$group": {"_id": "$files_id"}},
+            ])
+        ]
+
+        count = freed_bytes = 0
+        for batch in _batches(files_ids, self.batch_size):
+            existing = set(await db.fs.files.distinct("_id", {"_id": {"$in": batch}}))
+            missing = [files_id for files_id in batch if files_id not in existing]
+            if missing:
+                orphan_query = {"files_id": {"$in": missing}, "_id": {"$lt": cutoff}}
+                async for row in db.fs.chunks.aggregate([
+                    {"$match": orphan_query},
+                    {"$group": {"_id": None, "chunks": {"$sum": 1}, "bytes": {"$sum": {"$binarySize": "$data"}}}},
+                ]):
+                    count += row["chunks"]
+                    freed_bytes += row["bytes"]
+                if not dry_run:
+                    await db.fs.chunks.delete_many(orphan_query)
+            await self._pause()
+        return {"count": count, "bytes": freed_bytes}
+
+    async def _sweep_dangling_files(self, cutoff, dry_run):
+        files = [
+            file_doc["_id"] async for file_doc in db.fs.files.find(
+                {"length": {"$gt": 0}, "_id": {"$lt": cutoff}}, {"_id": 1}
+            )
+        ]
+
+        count = 0
+        for batch in _batches(files, self.batch_size):
+            has_chunks = set(await db.fs.chunks.distinct("files_id", {"files_id": {"$in": batch}, "n": 0}))
+            dangling = [file_id for file_id in batch if file_id not in has_chunks]
+            if dangling and not dry_run:
+                # Images pointing at these could never be served anyway
+                async for record in images_collection.find({"blob_id": {"$in": dangling}}, {"_id": 1}):
+                    image_records.invalidate(str(record["_id"]))
+                await images_collection.delete_many({"blob_id": {"$in": dangling}})
+                await db.fs.chunks.delete_many({"files_id": {"$in": dangling}})
+                await db.fs.files.delete_many({"_id": {"$in": dangling}})
+                for file_id in dangling:
+                    image_cache.invalidate(str(file_id))
+            count += len(dangling)
+            await self._pause()
+        return {"count": count, "bytes": 0}
+
+    def start(self):
+        if self.interval_seconds > 0 and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            try:
+                await self.run()
+            except Exception as e:
+                print(f"Image GC failed: {e}")
+
+    def stats(self):
+        return {
+            "running": self.running(),
+            "runs": self.runs,
+            "total_reclaimed_bytes": self.total_reclaimed_bytes,
+            "last_report": self.last_report,
+        }
+
+# IMAGE_GC_INTERVAL_SECONDS=0 turns the background sweep off (the admin endpoint still works)
+image_gc = ImageCollector(
+    interval_seconds=float(os.getenv("IMAGE_GC_INTERVAL_SECONDS", 6 * 3600)),
+    grace_seconds=float(os.getenv("IMAGE_GC_GRACE_SECONDS", 24 * 3600)),
+    batch_size=int(os.getenv("IMAGE_GC_BATCH_SIZE", 100)),
+    batch_pause=float(os.getenv("IMAGE_GC_BATCH_PAUSE_SECONDS", 0.5)),
+)
@@ -0,0 +1,230 @@
+import hashlib
+import os
+from datetime import datetime, timezone
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from database import db, storage_collectors
+from cache import TTLCache
+from image_store import save_stream, image_cache
+from image_variants import schedule_variants, delete_variants
+
+# One document per uploaded image:
+# {"_id", "blob_id": fs.files id, "filename", "length", "sha256", "uploadDate", "metadata"}
+# Identical uploads point at the same fs.files blob, which counts its references in "refcount".
+images_collection = db["images"]
+
+# Records never change once written, they only get deleted, so they can be kept for a while
+image_records = TTLCache(
+    max_entries=int(os.getenv("IMAGE_RECORD_CACHE_MAX_ENTRIES", 10000)),
+    ttl_seconds=float(os.getenv("IMAGE_RECORD_CACHE_TTL_SECONDS", 3600)),
+)
+
+def record_from_file(file_doc: dict):
+    """
+    Record for an image stored before records existed, under its old fs.files id
+    """
+    return {
+        "_id": file_doc["_id"],
+        "blob_id": file_doc["_id"],
+        "filename": file_doc.get("filename"),
+        "length": file_doc.get("length", 0),
+        "sha256": file_doc.get("sha256"),
+        # The oldest files have no uploadDate, but their id says when they were made
+        "uploadDate": file_doc.get("uploadDate") or file_doc["_id"].generation_time,
+        "metadata": file_doc.get("metadata", {}),
+    }
+
+async def store_image(chunks, filename: str, metadata: dict):
+    """
+    Saving an upload as a new image. The bytes go straight into GridFS and are
+    hashed on the way; if a blob with the same content was already stored we
+    add a reference to that one and drop the copy we just wrote.
+    Returns the new image id, its length and whether it was a duplicate.
+    """
+    digest = hashlib.sha256()
+    blob_id, length = await save_stream(
+        chunks, filename,
+        {"content_type": metadata.get("content_type")},
+        fields={"refcount": 1},
+        digest=digest
+    )
+    sha256 = digest.hexdigest()
+
+    # The oldest copy wins, so two identical uploads at once don't each pick the other
+    existing = await db.fs.files.find_one(
+        {"sha256": sha256, "length": length, "refcount": {"$gt": 0}, "_id": {"$lt": blob_id}},
+        {"_id": 1},
+        sort=[("_id", 1)]
+    )
+
+    record = {
+        "_id": ObjectId(),
+        "blob_id": existing["_id"] if existing else blob_id,
+        "filename": filename,
+        "length": length,
+        "sha256": sha256,
+        "uploadDate": datetime.now(timezone.utc),
+        "metadata": metadata,
+    }
+    try:
+        await images_collection.insert_one(record)
+    except Exception:
+        await release_blob(blob_id)
+        raise
+
+    # The record goes in before the reference, so the GC never sees a reference
+    # with no image behind it and frees a blob we're about to use
+    deduplicated = False
+    if existing:
+        # refcount > 0 so we never grab a blob that's in the middle of being deleted
+        taken = await db.fs.files.find_one_and_update(
+            {"_id": existing["_id"], "refcount": {"$gt": 0}},
+            {"$inc": {"refcount": 1}},
+            projection={"_id": 1}
+        )
+        if taken:
+            deduplicated = True
+            await release_blob(blob_id)
+        else:
+            # It went away meanwhile, keep the copy we wrote
+            record["blob_id"] = blob_id
+            await images_collection.update_one({"_id": record["_id"]}, {"$set": {"blob_id": blob_id}})
+    image_records.put(str(record["_id"]), record)
+
+    if not deduplicated:
+        schedule_variants(blob_id)
+    return record["_id"], length, deduplicated
+
+async def find_image(image_id: ObjectId):
+    """
+    Looking up an image record, falling back to fs.files for images that
+    haven't been migrated to records yet
+    """
+    key = str(image_id)
+    generation = image_records.generation
+    record = image_records.get(key)
+    if record is not None:
+        return record
+
+    record = await images_collection.find_one({"_id": image_id})
+    if record is None:
+        file_doc = await db.fs.files.find_one(
+            {"_id": image_id, "metadata.variant_of": {"$exists": False}},
+            {"filename": 1, "length": 1, "sha256": 1, "uploadDate": 1, "metadata": 1}
+        )
+        if file_doc is None:
+            return None
+        record = record_from_file(file_doc)
+    image_records.put(key, record, generation)
+    return record
+
+async def delete_blob(blob_id):
+    """
+    Deleting a blob nothing points at anymore, with its chunks and variants
+    """
+    result = await db.fs.files.delete_one({"_id": blob_id, "refcount": {"$lte": 0}})
+    if result.deleted_count == 0:
+        return False
+    image_cache.invalidate(str(blob_id))
+    await db.fs.chunks.delete_many({"files_id": blob_id})
+    await delete_variants(blob_id)
+    return True
+
+async def release_blob(blob_id):
+    """
+    Dropping one reference to a blob, deleting it when it was the last one
+    """
+    blob = await db.fs.files.find_one_and_update(
+        {"_id": blob_id, "refcount": {"$gt": 0}},
+        {"$inc": {"refcount": -1}},
+        projection={"refcount": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if blob is None or blob.get("refcount", 0) > 0:
+        return False
+    return await delete_blob(blob_id)
+
+async def remove_image(image_id: ObjectId):
+    """
+    Deleting an image. Its bytes are only freed once no other image uses them.
+    Returns False if there was no such image.
+    """
+    image_records.invalidate(str(image_id))
+    record = await images_collection.find_one_and_delete({"_id": image_id})
+    if record is not None:
+        await release_blob(record["blob_id"])
+        return True
+
+    # Not migrated yet, so the image is its own unshared fs.files document
+    result = await db.fs.files.delete_one(
+        {"_id": image_id, "refcount": {"$exists": False}, "metadata.variant_of": {"$exists": False}}
+    )
+    if result.deleted_count == 0:
+        return False
+    image_cache.invalidate(str(image_id))
+    await db.fs.chunks.delete_many({"files_id": image_id})
+    await delete_variants(image_id)
+    return True
+
+async def migrate_legacy_images(batch_size: int = 500):
+    """
+    Giving every fs.files image from before records existed a record under its
+    old id (so old URLs keep working) and a refcount of 1. Runs on startup and
+    is safe to rerun if it gets interrupted.
+    """
+    migrated = 0
+    batch = []
+    cursor = db.fs.files.find(
+        {"refcount": {"$exists": False}, "metadata.variant_of": {"$exists": False}},
+        {"filename": 1, "length": 1, "sha256": 1, "uploadDate": 1, "metadata": 1}
+    )
+    async for file_doc in cursor:
+        batch.append(file_doc)
+        if len(batch) >= batch_size:
+            migrated += await _migrate_batch(batch)
+            batch = []
+    if batch:
+        migrated += await _migrate_batch(batch)
+    if migrated:
+        print(f"Created image records for {migrated} existing images")
+    return migrated
+
+async def _migrate_batch(file_docs):
+    updates = []
+    for file_doc in file_docs:
+        record = record_from_file(file_doc)
+        del record["_id"]  # comes from the filter on insert
+        updates.append(UpdateOne({"_id": file_doc["_id"]}, {"$setOnInsert": record}, upsert=True))
+    await images_collection.bulk_write(updates, ordered=False)
+
+    ids = [file_doc["_id"] for file_doc in file_docs]
+    result = await db.fs.files.update_many(
+        {"_id": {"$in": ids}, "refcount": {"$exists": False}},
+        {"$set": {"refcount": 1}}
+    )
+    return result.modified_count
+
+async def dedup_stats():
+    """
+    How much storage sharing blobs between identical images saves
+    """
+    totals = {"blobs": 0, "references": 0, "stored_bytes": 0, "logical_bytes": 0}
+    async for row in db.fs.files.aggregate([
+        {"$match": {"refcount": {"$gt": 0}}},
+        {"$group": {
+            "_id": None,
+            "blobs": {"$sum": 1},
+            "references": {"$sum": "$refcount"},
+            "stored_bytes": {"$sum": "$length"},
+            "logical_bytes": {"$sum": {"$multiply": ["$length", "$refcount"]}},
+        }},
+    ]):
+        totals.update({key: row[key] for key in totals})
+
+    stored = totals["stored_bytes"]
+    totals["bytes_saved"] = totals["logical_bytes"] - stored
+    totals["dedup_ratio"] = totals["logical_bytes"] / stored if stored else 1.0
+    return totals
+
+# Reported (and cached) with the rest of /metrics/storage
+storage_collectors["image_dedup"] = dedup_stats
@@ -0,0 +1,238 @@
+import base64
+import hashlib
+import os
+import tempfile
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi import UploadFile
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from database import db
+from cache import ByteLRUCache
+
+# Same as the GridFS default, keeps every fs.chunks document far below the 16 MB BSON limit
+CHUNK_SIZE = 255 * 1024
+
+# An image stored under an id never changes, so browsers can keep it for a year
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+fs_bucket = AsyncIOMotorGridFSBucket(db, chunk_size_bytes=CHUNK_SIZE)
+
+# Hot images (mostly avatars) are kept in memory as (fs.files doc, bytes), keyed by image id
+image_cache = ByteLRUCache(
+    max_bytes=int(os.getenv("IMAGE_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+    max_entry_bytes=int(os.getenv("IMAGE_CACHE_MAX_ENTRY_BYTES", 1024 * 1024)),
+)
+
+async def iter_upload_file(file: UploadFile, chunk_size: int = CHUNK_SIZE):
+    """
+    Reading an uploaded file a chunk at a time instead of all at once
+    """
+    while True:
+        data = await file.read(chunk_size)
+        if not data:
+            break
+        yield data
+
+async def iter_base64(data: str, chunk_size: int = CHUNK_SIZE):
+    """
+    Decoding a base64 string a piece at a time, so the whole decoded
+    image never has to sit in memory next to the original string
+    """
+    if any(c in data for c in " \r\n\t"):
+        data = "".join(data.split())
+    # 4 base64 characters decode to exactly 3 bytes, so slice on multiples of 4
+    step = max(chunk_size // 3, 1) * 4
+    for offset in range(0, len(data), step):
+        yield base64.b64decode(data[offset:offset + step], validate=True)
+
+async def iter_bytes(data: bytes, chunk_size: int = CHUNK_SIZE):
+    """
+    Feeding bytes we already have in memory to save_stream
+    """
+    for offset in range(0, len(data), chunk_size):
+        yield data[offset:offset + chunk_size]
+
+async def spool(chunks, max_memory: int = 1024 * 1024):
+    """
+    Copying a stream into a temporary file (kept in memory while it's small)
+    for when it has to outlive the request. The caller closes it.
+    """
+    spooled = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    try:
+        async for data in chunks:
+            spooled.write(data)
+    except Exception:
+        spooled.close()
+        raise
+    spooled.seek(0)
+    return spooled
+
+async def save_stream(chunks, filename: str, metadata: dict, cache: bool = True, fields: dict = None, digest=None):
+    """
+    Writing an async stream of bytes into GridFS as fixed-size chunks, hashing
+    the content as it goes by (into `digest` if the caller wants the hash).
+    `fields` are extra top-level fields for the fs.files document. Small files
+    also go straight into the image cache unless cache=False. Returns the new
+    file id and its length.
+    """
+    grid_in = fs_bucket.open_upload_stream(filename, metadata=metadata)
+    digest = digest or hashlib.sha256()
+    # Only hang on to the bytes while the file is still small enough to cache
+    cacheable = [] if cache else None
+    cacheable_size = 0
+    try:
+        async for data in chunks:
+            digest.update(data)
+            await grid_in.write(data)
+            if cacheable is not None:
+                cacheable.append(data)
+                cacheable_size += len(data)
+                if cacheable_size > image_cache.max_entry_bytes:
+                    cacheable = None
+        # Saved on the fs.files document when the file is closed
+        await grid_in.set("sha256", digest.hexdigest())
+        for name, value in (fields or {}).items():
+            await grid_in.set(name, value)
+        await grid_in.close()
+    except Exception:
+        # Don't leave half-written chunks behind (closing can fail on a unique index too)
+        await grid_in.abort()
+        raise
+
+    if cacheable is not None:
+        file_doc = {
+            "_id": grid_in._id,
+            "filename": filename,
+            "metadata": metadata,
+            "length": grid_in.length,
+            "chunkSize": grid_in.chunk_size,
+            "uploadDate": grid_in.upload_date,
+            "sha256": digest.hexdigest(),
+            **(fields or {}),
+        }
+        image_cache.put(str(grid_in._id), (file_doc, b"".join(cacheable)), cacheable_size)
+    return grid_in._id, grid_in.length
+
+async def read_file(file_doc: dict):
+    """
+    Reading a whole stored file into memory. Only meant for small files.
+    """
+    return b"".join([data async for data in iter_chunks(file_doc)])
+
+def etag_for(file_doc: dict):
+    """
+    Strong ETag for a stored file. Files uploaded before we hashed content
+    fall back to id + length, which is just as stable since files never change.
+    """
+    if file_doc.get("sha256"):
+        return '"%s"' % file_doc["sha256"]
+    return '"%s-%s"' % (file_doc["_id"], file_doc.get("length", 0))
+
+def last_modified_for(file_doc: dict):
+    """
+    When the file was stored, as a timezone-aware UTC datetime
+    """
+    uploaded = file_doc.get("uploadDate") or file_doc["_id"].generation_time
+    if uploaded.tzinfo is None:
+        uploaded = uploaded.replace(tzinfo=timezone.utc)
+    return uploaded.astimezone(timezone.utc).replace(microsecond=0)
+
+def cache_headers(file_doc: dict):
+    return {
+        "ETag": etag_for(file_doc),
+        "Last-Modified": format_datetime(last_modified_for(file_doc), usegmt=True),
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+    }
+
+def is_not_modified(file_doc: dict, if_none_match: str = None, if_modified_since: str = None):
+    """
+    Checking the conditional request headers against the stored file.
+    If-None-Match wins when both are sent, like the HTTP spec says.
+    """
+    if if_none_match:
+        if if_none_match.strip() == "*":
+            return True
+        etag = etag_for(file_doc)
+        candidates = [tag.strip() for tag in if_none_match.split(",")]
+        # If-None-Match uses weak comparison, so ignore any W/ prefix
+        return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return last_modified_for(file_doc) <= since
+
+    return False
+
+def parse_range(range_header: str, length: int):
+    """
+    Turning a "bytes=start-end" header into an inclusive (start, end) pair.
+    Returns None when the whole file should be sent (no header, or a
+    multi-range request we don't support) and raises ValueError when the
+    range can't be satisfied.
+    """
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+
+    ranges = range_header[len("bytes="):].strip()
+    if "," in ranges:
+        return None
+
+    start_str, sep, end_str = ranges.partition("-")
+    if not sep:
+        return None
+    try:
+        if start_str == "":
+            # Suffix range: the last N bytes
+            suffix = int(end_str)
+            if suffix <= 0:
+                raise ValueError("Empty suffix range")
+            start = max(length - suffix, 0)
+            end = length - 1
+        else:
+            start = int(start_str)
+            end = int(end_str) if end_str else length - 1
+    except ValueError:
+        raise ValueError(f"Malformed range: {range_header}")
+
+    if start >= length or start > end:
+        raise ValueError(f"Range not satisfiable: {range_header}")
+    return start, min(end, length - 1)
+
+async def iter_chunks(file_doc: dict, start: int = 0, end: int = None):
+    """
+    Streaming the bytes start..end (inclusive) of a stored file, fetching
+    only the chunks that cover that range and only a few at a time.
+    """
+    length = file_doc.get("length", 0)
+    if length == 0:
+        return
+    if end is None:
+        end = length - 1
+
+    # Files written before the GridFS bucket are a single chunk with no chunkSize
+    chunk_size = file_doc.get("chunkSize") or length
+    first = start // chunk_size
+    last = end // chunk_size
+
+    cursor = db.fs.chunks.find(
+        {"files_id": file_doc["_id"], "n": {"$gte": first, "$lte": last}}
+    ).sort("n", 1).batch_size(4)
+
+    expected = first
+    async for chunk in cursor:
+        if chunk["n"] != expected:
+            raise IOError(f"Missing chunk {expected} for file {file_doc['_id']}")
+        data = chunk["data"]
+        chunk_start = chunk["n"] * chunk_size
+        lo = max(start - chunk_start, 0)
+        hi = min(end + 1 - chunk_start, len(data))
+        yield data[lo:hi]
+        expected += 1
+
+    if expected <= last:
+        raise IOError(f"Missing chunk {expected} for file {file_doc['_id']}")
@@ -0,0 +1,186 @@
+import asyncio
+import io
+import os
+from pymongo.errors import DuplicateKeyError
+from database import db
+from cache import SingleFlight
+from executors import BoundedExecutor, ExecutorSaturated
+from image_store import save_stream, iter_bytes, read_file, image_cache
+
+# Pillow is optional, without it every request just gets the original image
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Every stored image gets resized to these widths (roster avatars, cards, full view)
+VARIANT_WIDTHS = (64, 256, 1024)
+VARIANT_FORMATS = ("webp", "jpeg")
+VARIANT_CONTENT_TYPES = {"webp": "image/webp", "jpeg": "image/jpeg"}
+VARIANT_QUALITY = int(os.getenv("IMAGE_VARIANT_QUALITY", 82))
+
+# Don't try to decode anything bigger than this
+MAX_SOURCE_BYTES = int(os.getenv("IMAGE_VARIANT_MAX_SOURCE_BYTES", 20 * 1024 * 1024))
+
+# Decoding and re-encoding images is CPU-bound, so it runs in separate processes
+image_executor = BoundedExecutor(
+    "image",
+    max_workers=int(os.getenv("IMAGE_WORKERS", 2)),
+    max_queue=int(os.getenv("IMAGE_MAX_QUEUE", 32)),
+    processes=True,
+)
+
+# Two requests for a missing variant of the same image share one resize
+variant_builds = SingleFlight()
+
+# asyncio only keeps weak references to tasks, so hang on to the ones started after uploads
+_background_builds = set()
+
+def render_variants(data: bytes, widths, formats, quality: int = VARIANT_QUALITY):
+    """
+    Resizing one image to every width in every format. Runs in a worker
+    process, so it only deals in bytes. Returns a list of (width, format, bytes).
+    Images narrower than a width are re-encoded at their own size, never upscaled.
+    """
+    rendered = []
+    with Image.open(io.BytesIO(data)) as source:
+        # Phones store rotation in EXIF, bake it in before it gets stripped
+        source = ImageOps.exif_transpose(source)
+        for width in widths:
+            resized = source.copy()
+            resized.thumbnail((width, width * 10), Image.LANCZOS)
+            for fmt in formats:
+                image = resized
+                if fmt == "jpeg" and image.mode not in ("RGB", "L"):
+                    image = image.convert("RGB")
+                elif fmt == "webp" and image.mode not in ("RGB", "RGBA", "L"):
+                    image = image.convert("RGBA")
+                out = io.BytesIO()
+                image.save(out, format=fmt.upper(), quality=quality)
+                rendered.append((width, fmt, out.getvalue()))
+    return rendered
+
+def pick_width(requested: int = None):
+    """
+    Smallest variant at least as wide as what was asked for. None means the
+    original (nothing asked for, or wider than our biggest variant).
+    """
+    if not requested:
+        return None
+    for width in VARIANT_WIDTHS:
+        if width >= requested:
+            return width
+    return None
+
+def pick_format(accept: str = None):
+    return "webp" if accept and "image/webp" in accept else "jpeg"
+
+def variant_key(image_id, width: int, fmt: str):
+    return f"{image_id}@{width}.{fmt}"
+
+def can_resize(file_doc: dict):
+    content_type = file_doc.get("metadata", {}).get("content_type", "image/jpeg")
+    return (
+        Image is not None
+        and content_type.startswith("image/")
+        and content_type != "image/svg+xml"
+        and 0 < file_doc.get("length", 0) <= MAX_SOURCE_BYTES
+        and "variant_of" not in file_doc.get("metadata", {})
+    )
+
+async def build_variants(file_doc: dict):
+    """
+    Generating and storing whichever variants of an image don't exist yet.
+    Returns how many were stored.
+    """
+    if not can_resize(file_doc):
+        return 0
+
+    original_id = file_doc["_id"]
+    existing = set()
+    async for doc in db.fs.files.find({"metadata.variant_of": original_id}, {"metadata": 1}):
+        existing.add((doc["metadata"].get("width"), doc["metadata"].get("format")))
+    if len(existing) >= len(VARIANT_WIDTHS) * len(VARIANT_FORMATS):
+        return 0
+
+    data = await read_file(file_doc)
+    rendered = await image_executor.run(render_variants, data, VARIANT_WIDTHS, VARIANT_FORMATS)
+
+    stem = file_doc.get("filename", str(original_id)).rsplit(".", 1)[0]
+    stored = 0
+    for width, fmt, content in rendered:
+        if (width, fmt) in existing:
+            continue
+        metadata = {
+            "variant_of": original_id,
+            "width": width,
+            "format": fmt,
+            "content_type": VARIANT_CONTENT_TYPES[fmt],
+        }
+        try:
+            # Cached under its variant key when it's requested, not under its own id
+            await save_stream(iter_bytes(content), f"{stem}-{width}.{fmt}", metadata, cache=False)
+            stored += 1
+        except DuplicateKeyError:
+            # Someone else (another worker) stored this one first
+            pass
+    print(f"Stored {stored} variants for image {original_id}")
+    return stored
+
+async def _build_after_upload(file_id):
+    try:
+        file_doc = await db.fs.files.find_one({"_id": file_id})
+        if file_doc:
+            await variant_builds.run(file_id, lambda: build_variants(file_doc))
+    except ExecutorSaturated:
+        # Not a problem, they get built on first request instead
+        print(f"Image pool busy, variants for {file_id} will be built on demand")
+    except Exception as e:
+        print(f"Error building variants for {file_id}: {str(e)}")
+
+def schedule_variants(file_id):
+    """
+    Building an upload's variants in the background so the upload itself
+    doesn't wait on the resizing
+    """
+    if Image is None:
+        return
+    task = asyncio.create_task(_build_after_upload(file_id))
+    _background_builds.add(task)
+    task.add_done_callback(_background_builds.discard)
+
+async def get_variant(file_doc: dict, width: int, fmt: str):
+    """
+    Finding the stored (width, fmt) variant of an image, building it first if
+    it's missing. Returns its fs.files doc, or None when the original should be
+    served instead. The bytes are left to the caller, so a 304 never reads chunks.
+    """
+    query = {"metadata.variant_of": file_doc["_id"], "metadata.width": width, "metadata.format": fmt}
+    variant = await db.fs.files.find_one(query)
+    if variant is None:
+        if not can_resize(file_doc):
+            return None
+        try:
+            await variant_builds.run(file_doc["_id"], lambda: build_variants(file_doc))
+        except ExecutorSaturated:
+            print(f"Image pool busy, serving original for {file_doc['_id']}")
+            return None
+        except Exception as e:
+            print(f"Could not build variants for {file_doc['_id']}: {str(e)}")
+            return None
+        variant = await db.fs.files.find_one(query)
+    return variant
+
+async def delete_variants(original_id):
+    """
+    Removing every stored variant of an image along with their cache entries
+    """
+    for width in VARIANT_WIDTHS:
+        for fmt in VARIANT_FORMATS:
+            image_cache.invalidate(variant_key(original_id, width, fmt))
+
+    variant_ids = [doc["_id"] async for doc in db.fs.files.find({"metadata.variant_of": original_id}, {"_id": 1})]
+    if variant_ids:
+        await db.fs.chunks.delete_many({"files_id": {"$in": variant_ids}})
+        await db.fs.files.delete_many({"_id": {"$in": variant_ids}})
+    return len(variant_ids)
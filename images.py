@@ -1,10 +1,19 @@
-from fastapi import APIRouter, HTTPException, UploadFile, File, Depends
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, HTTPException, UploadFile, File, Depends, Header, Query, Request
+from fastapi.responses import StreamingResponse, Response
 from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
-import io
+from bson.errors import InvalidId
 from database import db
-from typing import List
+from image_store import (
+    iter_upload_file, iter_chunks, read_file, parse_range,
+    cache_headers, is_not_modified, image_cache
+)
+from image_variants import pick_width, pick_format, variant_key, get_variant
+from image_records import images_collection, store_image, find_image, remove_image
+from image_gc import image_gc
+from user_cache import invalidate_user
+from pagination import paginate, MAX_PAGE_SIZE
+from typing import List, Optional
 
 router = APIRouter(prefix="/images", tags=["images"])
 
@@ -27,10 +36,6 @@ async def upload_image(file: UploadFile = File(...), user_id: str = None, is_pro
     if not content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File must be an image")
     
-    # Reading the file contents
-    contents = await file.read()
-    print(f"File size: {len(contents)} bytes")
-    
     # Creating some helpful metadata to keep track of the image
     metadata = {"filename": file.filename, "content_type": content_type}
     if user_id:
@@ -41,35 +46,22 @@ async def upload_image(file: UploadFile = File(...), user_id: str = None, is_pro
     print(f"Metadata: {metadata}")
     
     try:
-        # Saving the file info to MongoDB - Using the motor async client directly
-        # First, create a file entry
-        file_doc = {
-            "filename": file.filename,
-            "metadata": metadata,
-            "length": len(contents)
-        }
-        print("Attempting to insert file document...")
-        result = await db.fs.files.insert_one(file_doc)
-        file_id = result.inserted_id
-        print(f"File document inserted with ID: {file_id}")
-        
-        # Then store the file data
-        chunk_doc = {
-            "files_id": file_id,
-            "n": 0,  # Chunk number
-            "data": contents
-        }
-        print("Attempting to insert chunk document...")
-        await db.fs.chunks.insert_one(chunk_doc)
-        print("Chunk document inserted successfully")
+        # Streaming the upload in chunk by chunk so we never hold the whole file.
+        # Bytes we already have stored get shared instead of saved again.
+        file_id, length, deduplicated = await store_image(iter_upload_file(file), file.filename, metadata)
+        print(f"Image stored with ID: {file_id} ({length} bytes, duplicate: {deduplicated})")
         
         # If this is a profile picture, update the user's profile
         if user_id and is_profile_picture:
             print(f"Updating user profile with image ID: {file_id}")
-            await db.users.update_one(
+            # Same field and URL format the profile page uses, so the GC sees it as in use
+            user = await db.users.find_one_and_update(
                 {"_id": ObjectId(user_id)},
-                {"$set": {"profile_picture": str(file_id)}}
+                {"$set": {"profile_pic": f"/images/{file_id}"}, "$unset": {"profile_picture": "", "profile_pic_job": ""}},
+                projection={"email": 1}
             )
+            if user:
+                invalidate_user(user["email"])
             print("User profile updated successfully")
         
         return {
@@ -91,64 +83,158 @@ async def set_profile_picture(user_id: str, file: UploadFile = File(...)):
     return image_response
 
 @router.get("/user/{user_id}")
-async def get_user_images(user_id: str):
+async def get_user_images(
+    user_id: str,
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+):
     """
-    Finding all images that belong to a specific user
+    Finding all images that belong to a specific user, a page at a time
     """
+    def image_summary(doc):
+        return {
+            "image_id": str(doc["_id"]),
+            "filename": doc["filename"],
+            "content_type": doc.get("metadata", {}).get("content_type", "image/jpeg")
+        }
+
     try:
         # Looking for all images linked to this user
-        cursor = db.fs.files.find({"metadata.user_id": user_id})
-        
-        # Building a list of all the images we find
-        images = []
-        async for doc in cursor:
-            images.append({
-                "image_id": str(doc["_id"]),
-                "filename": doc["filename"],
-                "content_type": doc.get("metadata", {}).get("content_type", "image/jpeg")
-            })
-        
-        return images
+        return await paginate(
+            request, images_collection,
+            {"metadata.user_id": user_id},
+            limit=limit, after=after,
+            projection={"filename": 1, "metadata.content_type": 1},
+            transform=image_summary
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error listing images: {str(e)}")
 
+@router.post("/gc")
+async def collect_garbage(
+    dry_run: bool = True,
+    grace_hours: Optional[float] = Query(None, ge=0, description="Only touch things older than this (defaults to IMAGE_GC_GRACE_SECONDS)"),
+):
+    """
+    Admin: sweeping away images nothing points at anymore. Defaults to a dry
+    run that only reports what would be deleted and how many bytes that frees.
+    """
+    if image_gc.running():
+        raise HTTPException(status_code=409, detail="Image GC is already running")
+    grace_seconds = grace_hours * 3600 if grace_hours is not None else None
+    try:
+        return await image_gc.run(dry_run=dry_run, grace_seconds=grace_seconds)
+    except Exception as e:
+        print(f"Error running image GC: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error running image GC: {str(e)}")
+
 @router.get("/{image_id}")
-async def get_image(image_id: str):
+async def get_image(
+    image_id: str,
+    w: Optional[int] = Query(None, ge=1, description="Width the image will be shown at"),
+    accept: Optional[str] = Header(None),
+    range_header: Optional[str] = Header(None, alias="Range"),
+    if_none_match: Optional[str] = Header(None),
+    if_modified_since: Optional[str] = Header(None),
+):
     """
-    Grabbing an image by its ID so we can display it
+    Grabbing an image by its ID so we can display it. Chunks are streamed
+    as they're read, Range requests get just the bytes they asked for, and
+    clients that already have the image get a 304 without us touching fs.chunks.
+    Passing ?w= gets the smallest resized copy at least that wide, as WebP
+    when the browser accepts it and JPEG otherwise.
     """
     print(f"Attempting to retrieve image with ID: {image_id}")
     try:
         # Convert the string ID to ObjectId
         obj_id = ObjectId(image_id)
-        print(f"Valid ObjectId: {obj_id}")
+        width = pick_width(w)
+        fmt = pick_format(accept) if width else None
         
-        # Looking up the file info using Motor's async methods
-        file_data = await db.fs.files.find_one({"_id": obj_id})
-        print(f"File data found: {file_data is not None}")
+        # Images point at a stored blob, which identical uploads share
+        record = await find_image(obj_id)
+        if not record:
+            print(f"No image found with ID: {image_id}")
+            raise HTTPException(status_code=404, detail="Image not found")
+        blob_id = record["blob_id"]
+        cache_key = variant_key(blob_id, width, fmt) if width else str(blob_id)
+        
+        # Hot images (and their resized copies) are served straight from memory
+        cached = image_cache.get(cache_key)
+        if cached:
+            file_data, content = cached
+        else:
+            # Looking up the file info using Motor's async methods
+            file_data = await db.fs.files.find_one({"_id": blob_id})
+            content = None
+            # Swapping in the resized copy, or keeping the original if there can't be one
+            if file_data and width:
+                variant = await get_variant(file_data, width, fmt)
+                if variant:
+                    file_data = variant
+                else:
+                    # Cached (below) under the original's key, not the variant's
+                    cache_key = str(blob_id)
         
         if not file_data:
             print(f"No file found with ID: {image_id}")
             raise HTTPException(status_code=404, detail="Image not found")
         
-        # Getting the actual image data
-        chunk = await db.fs.chunks.find_one({"files_id": obj_id})
-        print(f"Chunk data found: {chunk is not None}")
-        
-        if not chunk:
-            print(f"No chunk found for file ID: {image_id}")
-            raise HTTPException(status_code=404, detail="Image data not found")
-        
         # Figuring out what type of image it is
         content_type = file_data.get("metadata", {}).get("content_type", "image/jpeg")
-        print(f"Content type: {content_type}")
-        
-        # Sending the image back as a stream
+        length = file_data.get("length", 0)
+        headers = {"Accept-Ranges": "bytes", **cache_headers(file_data)}
+        if width:
+            # Same URL, different bytes depending on Accept
+            headers["Vary"] = "Accept"
+
+        # The browser already has this exact image
+        if is_not_modified(file_data, if_none_match, if_modified_since):
+            return Response(status_code=304, headers=headers)
+
+        try:
+            byte_range = parse_range(range_header, length)
+        except ValueError as e:
+            print(f"Bad range for image {image_id}: {str(e)}")
+            return Response(
+                status_code=416,
+                headers={"Content-Range": f"bytes */{length}", **headers}
+            )
+
+        if byte_range is None:
+            start, end, status_code = 0, length - 1, 200
+        else:
+            start, end = byte_range
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{length}"
+        headers["Content-Length"] = str(end - start + 1 if length else 0)
+
+        # Small images get read once and kept in the cache for next time
+        if content is None and length <= image_cache.max_entry_bytes:
+            content = await read_file(file_data)
+            image_cache.put(cache_key, (file_data, content), len(content))
+
+        if content is not None:
+            return Response(
+                content=content[start:end + 1],
+                status_code=status_code,
+                media_type=content_type,
+                headers=headers
+            )
+
+        # Sending the image back as a stream, one chunk at a time
         return StreamingResponse(
-            io.BytesIO(chunk["data"]),
-            media_type=content_type
+            iter_chunks(file_data, start, end),
+            status_code=status_code,
+            media_type=content_type,
+            headers=headers
         )
-    except ValueError as e:
+    except HTTPException:
+        raise
+    except (InvalidId, TypeError) as e:
         print(f"Invalid ObjectId format: {str(e)}")
         raise HTTPException(status_code=400, detail=f"Invalid image ID format: {str(e)}")
     except Exception as e:
@@ -164,13 +250,14 @@ async def delete_image(image_id: str):
         # Converting string ID to ObjectId
         obj_id = ObjectId(image_id)
         
-        # Cleaning up both the file info and the actual data
-        delete_file_result = await db.fs.files.delete_one({"_id": obj_id})
-        delete_chunks_result = await db.fs.chunks.delete_many({"files_id": obj_id})
-        
-        if delete_file_result.deleted_count == 0:
+        # The stored bytes (and resized copies) only go once no other image shares them
+        if not await remove_image(obj_id):
             raise HTTPException(status_code=404, detail="Image not found")
             
         return {"message": "Image deleted successfully"}
+    except HTTPException:
+        raise
+    except InvalidId as e:
+        raise HTTPException(status_code=400, detail=f"Invalid image ID format: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting image: {str(e)}") 
\ No newline at end of file
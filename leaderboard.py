@@ -0,0 +1,160 @@
+from fastapi import APIRouter, HTTPException, Query
+from database import db
+from mentors import mentor_directory
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from responses import FastJSONResponse
+from typing import Optional
+
+leaderboard_router = APIRouter()
+
+users_collection = db["users"]
+# One document per mentor group: {"_id": group key, "total_points": sum of member points}.
+# The key is the mentor's id, so a rename changes nothing here and two mentors
+# with the same name keep their own totals. Students whose mentor hasn't signed
+# up yet are grouped under the name they gave until the mentor does (see attach_mentees).
+group_totals_collection = db["group_totals"]
+
+LEADERBOARD_FIELDS = {"fullName": 1, "accountType": 1, "mentor_name": 1, "mentor_id": 1, "points": 1}
+
+DUPLICATE_KEY_ERROR = 11000
+# How many recent points batch ids a document remembers (see points_ledger)
+POINTS_BATCH_HISTORY = 50
+
+def group_key(mentor_name: Optional[str], mentor_id=None):
+    """
+    Which group_totals document a user's points count towards
+    """
+    if mentor_id is not None:
+        return mentor_id
+    return mentor_name or None
+
+def group_name(key):
+    # Names are only shown, the mentor's current one when there is a mentor
+    if isinstance(key, str):
+        return key
+    return mentor_directory.name_of(key)
+
+# Keep a group's total in step with a change to its members' points.
+# Call this from every code path that $incs points, with group_key() of the group.
+async def record_group_points(group: Optional[str], points_delta: int, members_changed: int = 1):
+    if group is None or not points_delta or not members_changed:
+        return
+    await group_totals_collection.update_one(
+        {"_id": group},
+        {"$inc": {"total_points": points_delta * members_changed}},
+        upsert=True
+    )
+
+# Same as record_group_points for many groups in one round trip.
+# `deltas` maps group_key() to the total change in points for that group.
+# With a batch_id (see points_ledger) each group only takes the batch once,
+# so replaying a batch after a crash doesn't count it twice.
+async def record_many_group_points(deltas: dict, batch_id=None):
+    updates = []
+    for group, delta in deltas.items():
+        if group is None or not delta:
+            continue
+        if batch_id is None:
+            updates.append(UpdateOne({"_id": group}, {"$inc": {"total_points": delta}}, upsert=True))
+        else:
+            updates.append(UpdateOne(
+                {"_id": group, "points_batches": {"$ne": batch_id}},
+                {"$inc": {"total_points": delta}, "$push": {"points_batches": {"$each": [batch_id], "$slice": -POINTS_BATCH_HISTORY}}},
+                upsert=True
+            ))
+    if not updates:
+        return
+    try:
+        await group_totals_collection.bulk_write(updates, ordered=False)
+    except BulkWriteError as e:
+        # The upsert of a group that already has this batch hits its own _id: already counted
+        if any(error.get("code") != DUPLICATE_KEY_ERROR for error in e.details.get("writeErrors", [])):
+            raise
+
+# Build the group totals from scratch the first time the app runs against a database,
+# or when they're still keyed by the names of groups that now have a mentor id.
+# Runs on startup after users are linked to their mentors.
+async def bootstrap_group_totals():
+    if await group_totals_collection.estimated_document_count() > 0:
+        names = await group_totals_collection.distinct("_id", {"_id": {"$type": "string"}})
+        if not names or not await users_collection.find_one(
+            {"$or": [
+                {"mentor_name": {"$in": names}, "mentor_id": {"$ne": None}},
+                {"fullName": {"$in": names}, "accountType": "Mentor"},
+            ]},
+            {"_id": 1}
+        ):
+            return
+    await users_collection.aggregate([
+        {"$match": {"$or": [{"mentor_id": {"$ne": None}}, {"mentor_name": {"$nin": [None, ""]}}]}},
+        {"$group": {"_id": {"$ifNull": ["$mentor_id", "$mentor_name"]}, "total_points": {"$sum": "$points"}}},
+        {"$out": "group_totals"}
+    ]).to_list(None)
+    print("Built group point totals")
+
+# Give tied scores the same rank (1, 2, 2, 4, ...)
+def add_ranks(entries, score_field):
+    ranked = []
+    for index, entry in enumerate(entries):
+        if index > 0 and entry.get(score_field, 0) == entries[index - 1].get(score_field, 0):
+            entry["rank"] = ranked[-1]["rank"]
+        else:
+            entry["rank"] = index + 1
+        ranked.append(entry)
+    return ranked
+
+# TOP USERS BY POINTS (optionally for one account type)
+@leaderboard_router.get("/users")
+async def top_users(account_type: Optional[str] = None, limit: int = Query(10, ge=1, le=100)):
+    query = {"accountType": account_type} if account_type else {}
+    cursor = users_collection.find(query, LEADERBOARD_FIELDS).sort("points", -1).limit(limit)
+
+    # points_ledger imports this module
+    from points_ledger import points_ledger
+    users = [points_ledger.with_pending(user) for user in await cursor.to_list(length=limit)]
+    # Points still on their way can reorder the page
+    users.sort(key=lambda user: user.get("points", 0), reverse=True)
+    return FastJSONResponse(add_ranks(users, "points"))
+
+# ONE USER'S RANK
+@leaderboard_router.get("/users/rank")
+async def user_rank(email: str, account_type: Optional[str] = None):
+    user = await users_collection.find_one({"email": email.strip()}, LEADERBOARD_FIELDS)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    # points_ledger imports this module
+    from points_ledger import points_ledger
+    points_ledger.with_pending(user)
+
+    # counting on the points index, no need to look at the documents themselves
+    query = {"points": {"$gt": user.get("points", 0)}}
+    if account_type:
+        query["accountType"] = account_type
+    ahead = await users_collection.count_documents(query)
+
+    user["rank"] = ahead + 1
+    return FastJSONResponse(user)
+
+# TOP MENTOR GROUPS BY TOTAL MEMBER POINTS
+@leaderboard_router.get("/groups")
+async def top_groups(limit: int = Query(10, ge=1, le=100)):
+    cursor = group_totals_collection.find().sort("total_points", -1).limit(limit)
+
+    groups = []
+    async for doc in cursor:
+        mentor_id = None if isinstance(doc["_id"], str) else str(doc["_id"])
+        groups.append({"mentor_name": group_name(doc["_id"]), "mentor_id": mentor_id, "total_points": doc.get("total_points", 0)})
+    return add_ranks(groups, "total_points")
+
+# ONE GROUP'S RANK
+@leaderboard_router.get("/groups/{mentor_name}/rank")
+async def group_rank(mentor_name: str):
+    mentor_id = await mentor_directory.resolve(mentor_name)
+    group = await group_totals_collection.find_one({"_id": group_key(mentor_name, mentor_id)})
+    if not group:
+        raise HTTPException(status_code=404, detail="Group not found")
+
+    total_points = group.get("total_points", 0)
+    ahead = await group_totals_collection.count_documents({"total_points": {"$gt": total_points}})
+    return {"mentor_name": group_name(group["_id"]) or mentor_name, "total_points": total_points, "rank": ahead + 1}
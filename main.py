@@ -1,13 +1,56 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
 from auth import auth_router
 from user_profile import profile_router
 from group import group_router
 from bucket_list import bucketlist_router
 from images import router as images_router
-from database import db, check_storage_metrics
+from leaderboard import leaderboard_router, bootstrap_group_totals
+from database import db, check_storage_metrics, ensure_indexes, open_database, close_database, MONGO_MAX_POOL_SIZE
+from image_store import image_cache
+from image_records import migrate_legacy_images
+from task_store import migrate_embedded_tasks
+from mentors import mentor_directory, migrate_mentor_ids
+from points_ledger import points_ledger
+from image_gc import image_gc
+from user_cache import user_cache_stats
+from executors import shutdown_executors
+from upload_jobs import upload_jobs
+from pagination import NEXT_CURSOR_HEADER
+from responses import FastJSONResponse
+from compression import CompressionMiddleware
+from metrics import MetricsMiddleware, render as render_metrics, PROMETHEUS_CONTENT_TYPE, pool_stats
 
-app = FastAPI()
+# How long /ready waits for Mongo to answer before calling it not ready
+READINESS_TIMEOUT_SECONDS = float(os.getenv("READINESS_TIMEOUT_SECONDS", 1))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await open_database()
+    # Make sure every query path has its index before we start serving
+    await ensure_indexes()
+    await mentor_directory.load()
+    # Tasks are moved by mentor id, so link everything to its mentor first
+    await migrate_mentor_ids()
+    # Group totals are keyed by mentor id too
+    await bootstrap_group_totals()
+    await migrate_embedded_tasks()
+    await migrate_legacy_images()
+    # Points awarded before a crash that never made it to the users
+    await points_ledger.recover()
+    points_ledger.start()
+    image_gc.start()
+    yield
+    await image_gc.stop()
+    await points_ledger.stop()
+    await upload_jobs.stop()
+    shutdown_executors()
+    close_database()
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -16,13 +59,53 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER], # so the frontend can read the next page cursor
 )
 
+# gzip/brotli for JSON bodies over the threshold (images are never recompressed)
+app.add_middleware(CompressionMiddleware, minimum_size=int(os.getenv("COMPRESSION_MIN_SIZE", 1024)))
+
+# Added last so it's outermost and times everything above, compression included
+app.add_middleware(MetricsMiddleware)
+
+# Prometheus scrape endpoint: request, Mongo command and worker pool metrics
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(content=render_metrics(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+# Readiness probe for the load balancer: fails right away when every pooled
+# connection is busy instead of queueing behind them like a real request would
+@app.get("/ready", include_in_schema=False)
+async def readiness():
+    pools = pool_stats()
+    exhausted = [
+        address for address, pool in pools.items()
+        if pool["in_use"] >= MONGO_MAX_POOL_SIZE and pool["waiting"] > 0
+    ]
+    if exhausted:
+        return FastJSONResponse(
+            {"status": "unavailable", "reason": "Mongo connection pool exhausted", "pools": pools},
+            status_code=503, headers={"Retry-After": "1"}
+        )
+    try:
+        await asyncio.wait_for(db.command("ping"), READINESS_TIMEOUT_SECONDS)
+    except Exception as e:
+        return FastJSONResponse(
+            {"status": "unavailable", "reason": f"Mongo not answering: {e!r}", "pools": pools},
+            status_code=503, headers={"Retry-After": "1"}
+        )
+    return FastJSONResponse({"status": "ready", "pools": pools})
+
 @app.get("/metrics/storage")
 async def get_storage_metrics():
     metrics = await check_storage_metrics()
     if metrics is None:
         raise HTTPException(status_code=500, detail="Failed to fetch storage metrics")
+    metrics["image_cache"] = image_cache.stats()
+    metrics["user_cache"] = user_cache_stats()
+    metrics["mentor_directory"] = mentor_directory.stats()
+    metrics["points_ledger"] = points_ledger.stats()
+    metrics["upload_jobs"] = upload_jobs.stats()
     return metrics
 
 # routers for authentication (login/sign up), profile updates/viewing
@@ -30,4 +113,5 @@ app.include_router(auth_router, prefix="/auth", tags=["auth"])
 app.include_router(profile_router, prefix="/profile", tags=["profile"])
 app.include_router(group_router, prefix="/group", tags=["group"])
 app.include_router(bucketlist_router, prefix="/bucketlist", tags=["bucketlist"])
+app.include_router(leaderboard_router, prefix="/leaderboard", tags=["leaderboard"])
 app.include_router(images_router) # Image handling routes
\ No newline at end of file
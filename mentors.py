@@ -0,0 +1,187 @@
+from pymongo import UpdateMany
+from database import db
+from user_cache import user_cache
+
+users_collection = db["users"]
+
+# Groups used to be joined on the free-text mentor name. Now mentees, bucket
+# lists and tasks carry "mentor_id" (the mentor's users _id) and keep
+# "mentor_name" only for display. URLs still use names, which go through here.
+# Mentors keep the names they've had before in "previous_names", so old links keep working
+MENTOR_FIELDS = {"fullName": 1, "previous_names": 1}
+
+class MentorDirectory:
+    """
+    Every mentor's name and id, kept in memory so turning a name from a URL
+    into an id doesn't need a query. Loaded on startup and updated when
+    mentors sign up or rename. A name this instance hasn't seen (e.g. another
+    instance handled the signup) is looked up once on the fullName index.
+    Old names keep resolving after a rename, so links people already have
+    still work, unless another mentor is called that now.
+    """
+
+    def __init__(self):
+        self._ids = {}      # current name -> mentor id
+        self._names = {}    # mentor id -> current name
+        self._aliases = {}  # old name -> mentor id
+        self.lookups = 0
+
+    def add(self, mentor_id, name: str):
+        """
+        Recording a mentor's current name. A name they had before becomes
+        an alias, so this is also how renames are recorded.
+        """
+        if not name:
+            return
+        old_name = self._names.get(mentor_id)
+        self._names[mentor_id] = name
+        if old_name and old_name != name:
+            self.add_alias(mentor_id, old_name)
+            if self._ids.get(old_name) == mentor_id:
+                # Someone else still called that gets the name
+                others = [other for other, current in self._names.items() if current == old_name]
+                if others:
+                    self._ids[old_name] = min(others)
+                else:
+                    del self._ids[old_name]
+
+        existing = self._ids.get(name)
+        # Names aren't unique, the mentor who signed up first keeps it
+        if existing is None or mentor_id < existing:
+            self._ids[name] = mentor_id
+        elif existing != mentor_id:
+            print(f"Two mentors are called {name}, URLs with that name go to {existing}")
+
+    def add_alias(self, mentor_id, name: str):
+        existing = self._aliases.get(name)
+        if name and (existing is None or mentor_id < existing):
+            self._aliases[name] = mentor_id
+
+    def name_of(self, mentor_id):
+        return self._names.get(mentor_id)
+
+    async def load(self):
+        self._ids.clear()
+        self._names.clear()
+        self._aliases.clear()
+        mentors = await users_collection.find({"accountType": "Mentor"}, MENTOR_FIELDS).sort("_id", 1).to_list(None)
+        for mentor in mentors:
+            self.add(mentor["_id"], mentor.get("fullName"))
+        for mentor in mentors:
+            for name in mentor.get("previous_names") or []:
+                self.add_alias(mentor["_id"], name)
+        print(f"Loaded {len(self._names)} mentors")
+
+    async def resolve(self, name: str):
+        """
+        The mentor id for a name (current first, then old ones), or None if
+        no mentor has ever had that name
+        """
+        if not name:
+            return None
+        mentor_id = self._ids.get(name, self._aliases.get(name))
+        if mentor_id is not None:
+            return mentor_id
+        self.lookups += 1
+        for field in ("fullName", "previous_names"):
+            mentor = await users_collection.find_one(
+                {field: name, "accountType": "Mentor"}, MENTOR_FIELDS, sort=[("_id", 1)]
+            )
+            if mentor is not None:
+                self.add(mentor["_id"], mentor["fullName"])
+                for old_name in mentor.get("previous_names") or []:
+                    self.add_alias(mentor["_id"], old_name)
+                return self._ids.get(name, self._aliases.get(name))
+        return None
+
+    async def resolve_many(self, names):
+        return {name: await self.resolve(name) for name in set(names)}
+
+    def stats(self):
+        return {"mentors": len(self._names), "names": len(self._ids), "aliases": len(self._aliases), "lookups": self.lookups}
+
+mentor_directory = MentorDirectory()
+
+def group_filter(mentor_name: str, mentor_id=None):
+    """
+    Query for a group's mentees. Students can sign up before their mentor
+    does, so a name with no mentor behind it still matches on mentor_name.
+    """
+    if mentor_id is not None:
+        return {"mentor_id": mentor_id}
+    return {"mentor_name": mentor_name, "mentor_id": None}
+
+async def attach_mentees(mentors):
+    """
+    Pointing students who signed up before their mentor at the mentor's id.
+    `mentors` is a list of (mentor id, name).
+    """
+    updates = [
+        UpdateMany({"mentor_name": name, "mentor_id": None}, {"$set": {"mentor_id": mentor_id}})
+        for mentor_id, name in mentors if name
+    ]
+    if not updates:
+        return
+    await users_collection.bulk_write(updates, ordered=False)
+    user_cache.clear()
+
+    # Their points were counted under the name until now. The new total is set
+    # from the members themselves (so running this twice can't count anyone twice)
+    # before the name's total goes.
+    for mentor_id, name in mentors:
+        if not name:
+            continue
+        total = 0
+        async for row in users_collection.aggregate([
+            {"$match": {"mentor_id": mentor_id}},
+            {"$group": {"_id": None, "total_points": {"$sum": "$points"}}},
+        ]):
+            total = row["total_points"]
+        await db.group_totals.update_one({"_id": mentor_id}, {"$set": {"total_points": total}}, upsert=True)
+        if not await users_collection.find_one({"mentor_name": name, "mentor_id": None}, {"_id": 1}):
+            await db.group_totals.delete_one({"_id": name})
+
+async def rename_mentor(mentor_id, old_name: str, new_name: str):
+    """
+    Carrying a mentor's new name over to everything that shows it. Every
+    update here is by mentor_id, so nothing gets lost if two groups share a name.
+    The group leaderboard is keyed by mentor_id, so it has nothing to move.
+    """
+    mentor_directory.add(mentor_id, new_name)
+    if old_name:
+        # Remembered on the mentor, so the old name still resolves after a restart
+        await users_collection.update_one({"_id": mentor_id}, {"$addToSet": {"previous_names": old_name}})
+    await users_collection.update_many({"mentor_id": mentor_id}, {"$set": {"mentor_name": new_name}})
+    await db.bucket_lists.update_many({"mentor_id": mentor_id}, {"$set": {"mentor_name": new_name}})
+    # Cached mentees still have the old name
+    user_cache.clear()
+
+async def migrate_mentor_ids():
+    """
+    Filling in mentor_id on mentees, bucket lists and tasks that only have a
+    mentor name. Runs on startup after the directory is loaded and only
+    touches documents that are still missing the id.
+    """
+    names = set()
+    for collection in (users_collection, db.bucket_lists):
+        names.update(await collection.distinct("mentor_name", {"mentor_id": None, "mentor_name": {"$nin": [None, ""]}}))
+    names.update(await db.tasks.distinct("mentor_name", {"mentor_id": None}))
+    if not names:
+        return 0
+
+    resolved = {name: mentor_id for name, mentor_id in (await mentor_directory.resolve_many(names)).items() if mentor_id}
+    changed = 0
+    if resolved:
+        for collection, unset in ((users_collection, False), (db.bucket_lists, False), (db.tasks, True)):
+            updates = []
+            for name, mentor_id in resolved.items():
+                change = {"$set": {"mentor_id": mentor_id}}
+                if unset:
+                    # Tasks only need the id, a copy of the name would go stale on rename
+                    change["$unset"] = {"mentor_name": ""}
+                updates.append(UpdateMany({"mentor_name": name, "mentor_id": None}, change))
+            result = await collection.bulk_write(updates, ordered=False)
+            changed += result.modified_count
+        user_cache.clear()
+    print(f"Linked {changed} documents to {len(resolved)} mentors by id")
+    return changed
@@ -0,0 +1,339 @@
+import bisect
+import threading
+import time
+from pymongo import monitoring
+from executors import executors
+
+# Prometheus text exposition format
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds. Covers cached reads (~1ms) up to bcrypt and big uploads.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """
+    Value per label combination that only goes up. Safe to use from
+    pymongo's threads as well as the event loop.
+    """
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def values(self):
+        """
+        Current value per label combination
+        """
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self):
+        for labels, value in self.values().items():
+            yield self.name, _labels(self.labelnames, labels), value
+
+class Gauge(Counter):
+    """
+    Value per label combination that goes up and down
+    """
+    kind = "gauge"
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value: float):
+        with self._lock:
+            self._values[labels] = value
+
+class CallbackMetric:
+    """
+    Gauge or counter that's only read when /metrics is scraped. `collect`
+    returns (label values, value) pairs, so there's nothing to keep up to date.
+    """
+
+    def __init__(self, name: str, help: str, labelnames, collect, kind: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self.kind = kind
+        registry.append(self)
+
+    def samples(self):
+        for labels, value in self.collect():
+            yield self.name, _labels(self.labelnames, labels), value
+
+class Histogram:
+    """
+    Latency histogram per label combination with fixed buckets
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [count per bucket (+Inf last), sum]
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, *labels, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self._lock:
+            items = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        bounds = self.buckets + (float("inf"),)
+        for labels, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                yield f"{self.name}_bucket", _labels(self.labelnames, labels, le), cumulative
+            yield f"{self.name}_sum", _labels(self.labelnames, labels), total
+            yield f"{self.name}_count", _labels(self.labelnames, labels), cumulative
+
+# Every metric, in the order they were created
+registry = []
+
+def render():
+    """
+    Every metric in Prometheus text format
+    """
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+# HTTP
+http_requests = Counter("http_requests_total", "Requests handled", ("method", "route", "status"))
+http_requests_in_flight = Gauge("http_requests_in_flight", "Requests being handled right now")
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "Time to handle a request, until the last byte is sent", ("method", "route", "status")
+)
+
+def route_template(scope):
+    """
+    The route a request matched, e.g. /bucketlist/{mentor_name}/bucket_lists.
+    A route only knows its own path, not the prefix of the router it was
+    included with (or the app it's mounted in), so the prefix is taken from
+    the front of the real path: it's always literal, never a path param.
+    Requests that matched nothing share one label.
+    """
+    route = scope.get("route")
+    if route is None:
+        return "unmatched"
+    template = getattr(route, "path_format", None) or getattr(route, "path", "")
+    path = scope.get("path", "")
+    prefix_parts = path.count("/") - template.count("/")
+    if prefix_parts <= 0:
+        return template
+    return "/".join(path.split("/")[:prefix_parts + 1]) + template
+
+class MetricsMiddleware:
+    """
+    Counting and timing every request by route template (e.g. /images/{image_id},
+    never the real path, so ids don't turn into thousands of series) and status.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_requests_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_requests_in_flight.dec()
+            # The router fills in the matched route on the way through
+            labels = (scope["method"], route_template(scope), str(status))
+            http_requests.inc(*labels)
+            http_request_duration.observe(*labels, value=time.perf_counter() - start)
+
+# Mongo
+mongo_commands = Counter("mongo_commands_total", "Commands sent to MongoDB", ("collection", "command", "outcome"))
+mongo_command_duration = Histogram(
+    "mongo_command_duration_seconds", "MongoDB command round trip time", ("collection", "command")
+)
+mongo_documents = Counter(
+    "mongo_documents_total", "Documents returned (reads) or affected (writes) by MongoDB commands", ("collection", "command")
+)
+
+# Commands that name their collection somewhere other than the first field
+COLLECTION_FIELDS = {"getMore": "collection"}
+
+def _documents_in_reply(command_name: str, reply: dict):
+    cursor = reply.get("cursor")
+    if cursor is not None:
+        return len(cursor.get("firstBatch") or cursor.get("nextBatch") or ())
+    if command_name == "findAndModify":
+        return 1 if reply.get("value") is not None else 0
+    n = reply.get("n")
+    return n if isinstance(n, int) else 0
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """
+    pymongo listener timing every command by collection and command name.
+    pymongo calls it from its own threads, so it only touches thread-safe metrics.
+    """
+
+    def __init__(self):
+        self._collections = {}  # (request_id, connection_id) -> collection, between started and finished
+
+    def started(self, event):
+        field = COLLECTION_FIELDS.get(event.command_name, event.command_name)
+        collection = event.command.get(field)
+        self._collections[(event.request_id, event.connection_id)] = collection if isinstance(collection, str) else ""
+
+    def _finished(self, event, outcome: str):
+        collection = self._collections.pop((event.request_id, event.connection_id), "")
+        mongo_commands.inc(collection, event.command_name, outcome)
+        mongo_command_duration.observe(collection, event.command_name, value=event.duration_micros / 1e6)
+        return collection
+
+    def succeeded(self, event):
+        collection = self._finished(event, "success")
+        documents = _documents_in_reply(event.command_name, event.reply)
+        if documents:
+            mongo_documents.inc(collection, event.command_name, amount=documents)
+
+    def failed(self, event):
+        self._finished(event, "failure")
+
+mongo_listener = MongoCommandMetrics()
+
+# Connection pool
+mongo_pool_connections = Gauge("mongo_pool_connections", "Open connections in the MongoDB pool", ("address",))
+mongo_pool_in_use = Gauge("mongo_pool_in_use", "Pool connections checked out right now", ("address",))
+mongo_pool_waiting = Gauge("mongo_pool_waiting", "Operations waiting for a pool connection", ("address",))
+mongo_pool_checkout_wait = Histogram(
+    "mongo_pool_checkout_wait_seconds", "Time spent waiting to get a connection out of the pool", ("address",)
+)
+mongo_pool_checkout_failures = Counter(
+    "mongo_pool_checkout_failures_total", "Pool checkouts that failed (timeouts, pool closed, ...)", ("address", "reason")
+)
+
+def _address(event):
+    host, port = event.address
+    return f"{host}:{port}"
+
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    pymongo listener keeping track of how busy the connection pool is.
+    pool_stats() sums it up for the readiness check.
+    """
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        address = _address(event)
+        for gauge in (mongo_pool_connections, mongo_pool_in_use, mongo_pool_waiting):
+            gauge.set(address, value=0)
+
+    def connection_created(self, event):
+        mongo_pool_connections.inc(_address(event))
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        mongo_pool_connections.dec(_address(event))
+
+    def connection_check_out_started(self, event):
+        mongo_pool_waiting.inc(_address(event))
+
+    def connection_check_out_failed(self, event):
+        address = _address(event)
+        mongo_pool_waiting.dec(address)
+        mongo_pool_checkout_failures.inc(address, str(event.reason))
+
+    def connection_checked_out(self, event):
+        address = _address(event)
+        mongo_pool_waiting.dec(address)
+        mongo_pool_in_use.inc(address)
+        # Newer pymongo versions time the checkout for us
+        duration = getattr(event, "duration", None)
+        if duration is not None:
+            mongo_pool_checkout_wait.observe(address, value=duration)
+
+    def connection_checked_in(self, event):
+        mongo_pool_in_use.dec(_address(event))
+
+pool_listener = MongoPoolMetrics()
+
+def pool_stats():
+    """
+    Open, checked out and waiting connections for each server's pool
+    """
+    servers = {}
+    for name, gauge in (("connections", mongo_pool_connections), ("in_use", mongo_pool_in_use), ("waiting", mongo_pool_waiting)):
+        for (address,), value in gauge.values().items():
+            servers.setdefault(address, {"connections": 0, "in_use": 0, "waiting": 0})[name] = int(value)
+    return servers
+
+# Worker pools (bcrypt, bcrypt-bulk, image), read from the pools themselves at scrape time
+def _executor_stats(field: str):
+    def collect():
+        for name, pool in list(executors.items()):
+            yield (name,), pool.stats()[field]
+    return collect
+
+CallbackMetric("executor_in_flight", "Jobs running on a worker pool", ("pool",), _executor_stats("in_flight"))
+CallbackMetric("executor_queue_depth", "Jobs waiting for a worker pool", ("pool",), _executor_stats("queued"))
+CallbackMetric("executor_completed_total", "Jobs a worker pool has finished", ("pool",), _executor_stats("completed"), kind="counter")
+CallbackMetric(
+    "executor_rejected_total", "Jobs turned away because a worker pool was saturated", ("pool",),
+    _executor_stats("rejected"), kind="counter"
+)
@@ -1,6 +1,7 @@
 from fastapi import FastAPI, APIRouter, HTTPException
 from pydantic import BaseModel, Field
 from typing import Optional, List
+from datetime import datetime
 from uuid import uuid4
 
 # Authentication Models
@@ -24,6 +25,7 @@ class Profile(BaseModel):
     email: str
     accountType: str
     mentor_name: Optional[str] = None
+    mentor_id: Optional[str] = None  # the mentor's user id, set by the server
     fun_facts: str
     points: int
     profile_pic: Optional[str] = None  # Store the image URL
@@ -39,11 +41,36 @@ class ProfilePicUpdate(BaseModel):
 class ProfileOut(Profile):
     id: str = Field(alias="_id")
 
+# Mongo projection with just the fields a response model returns, so queries
+# don't pull back anything (like password hashes) the response would drop anyway
+def projection_for(*models, extra=()):
+    projection = {}
+    for model in models:
+        for name, field in model.model_fields.items():
+            projection[field.alias or name] = 1
+    for name in extra:
+        projection[name] = 1
+    return projection
+
+PROFILE_PROJECTION = projection_for(ProfileOut)
+# login needs the hash to check the password, but it's never sent back
+LOGIN_PROJECTION = projection_for(ProfileOut, extra=("password",))
+
+# Group Models
+class GroupPointsAward(BaseModel):
+    mentor_name: str
+    points_added: int
+
+class BulkPointsAward(BaseModel):
+    awards: List[GroupPointsAward]
+    ordered: bool = False  # stop at the first failed award instead of applying the rest
+
 # Bucket List Models
 class Task(BaseModel):
     id: str = None
     description: str
     completed: bool = False
+    created_at: Optional[datetime] = None  # set by the server
 
     def model_post_init(self, __context):
         if self.id is None:
@@ -51,4 +78,6 @@ class Task(BaseModel):
 
 class BucketList(BaseModel):
     mentor_name: str
-    tasks: List[Task]
\ No newline at end of file
+    task_count: int = 0
+    completed_count: int = 0
+    tasks: List[Task] = []  # the first page, the rest come from /bucket_lists/{mentor_name}
\ No newline at end of file
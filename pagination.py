@@ -0,0 +1,106 @@
+import base64
+from bson import json_util
+from bson.errors import InvalidId
+from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
+from responses import FastJSONResponse, dumps
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+NDJSON = "application/x-ndjson"
+
+# Response header carrying the cursor for the next page (absent on the last page)
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+def encode_cursor(values):
+    """
+    Turning the sort key values of the last document on a page into an
+    opaque token the client passes back as ?after=
+    """
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode()).decode()
+
+def decode_cursor(token: str, keys):
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, TypeError, InvalidId):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def _greater_than(key, value):
+    # $gt only matches values of the same type. bucket_lists has both string and
+    # ObjectId ids, and ObjectIds sort after strings, so include them explicitly.
+    if key == "_id" and isinstance(value, str):
+        return {"$or": [{key: {"$gt": value}}, {key: {"$type": "objectId"}}]}
+    return {key: {"$gt": value}}
+
+def keyset_filter(keys, values):
+    """
+    Query matching every document that sorts after `values` when sorted
+    ascending on `keys`, e.g. for (a, b): a > va OR (a == va AND b > vb)
+    """
+    clauses = []
+    for i, key in enumerate(keys):
+        clause = dict(zip(keys[:i], values[:i]))
+        greater = _greater_than(key, values[i])
+        clauses.append({"$and": [clause, greater]} if clause else greater)
+    return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+def wants_ndjson(request: Request):
+    return NDJSON in request.headers.get("accept", "")
+
+def _plain(doc):
+    return doc
+
+async def paginate(
+    request: Request,
+    collection,
+    query: dict,
+    limit: int = None,
+    after: str = None,
+    keys=("_id",),
+    projection: dict = None,
+    transform=_plain,
+):
+    """
+    Keyset pagination over `collection`, sorted ascending on `keys` (which
+    should be backed by an index together with the query fields).
+
+    Normal requests get one page as a JSON list, with the cursor for the next
+    page in the X-Next-Cursor header. Clients sending Accept: application/x-ndjson
+    get every matching document (or `limit` of them) streamed one per line
+    as it comes off the cursor. Either way documents are sent as they come
+    back from Mongo, so the projection should already match the response model.
+    """
+    keys = list(keys)
+    if after:
+        after_query = keyset_filter(keys, decode_cursor(after, keys))
+        query = {"$and": [query, after_query]} if query else after_query
+
+    cursor = collection.find(query, projection).sort([(key, 1) for key in keys])
+
+    if wants_ndjson(request):
+        if limit:
+            cursor = cursor.limit(limit)
+
+        async def stream():
+            async for doc in cursor:
+                yield dumps(transform(doc)) + b"\n"
+
+        return StreamingResponse(stream(), media_type=NDJSON)
+
+    page_size = limit or DEFAULT_PAGE_SIZE
+    # One extra document tells us whether there's another page
+    cursor = cursor.limit(page_size + 1)
+
+    items = []
+    headers = {}
+    last_values = None
+    async for doc in cursor:
+        if len(items) == page_size:
+            headers[NEXT_CURSOR_HEADER] = encode_cursor(last_values)
+            break
+        last_values = [doc.get(key) for key in keys]
+        items.append(transform(doc))
+    return FastJSONResponse(items, headers=headers)
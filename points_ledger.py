@@ -0,0 +1,290 @@
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from pymongo import UpdateOne, UpdateMany
+from database import db
+from leaderboard import record_many_group_points, group_key, POINTS_BATCH_HISTORY
+from mentors import mentor_directory
+from user_cache import invalidate_group
+
+# Append-only record of every points award:
+# {"_id", "target": "user" | "group", "target_id": user id or mentor id, "points",
+#  "reason", "created_at", "batch_id": set when a flush claims it, "applied_at": set once it's in users}
+# Events with no applied_at are the outbox: they survive a crash and get applied on the next start.
+points_events = db["points_events"]
+users_collection = db["users"]
+
+def invalidate_groups(mentor_names):
+    for mentor_name in mentor_names:
+        if mentor_name:
+            invalidate_group(mentor_name)
+
+class PointsLedger:
+    """
+    Write-behind points. Every award is saved as an event first (so it's
+    never lost), then added to an in-memory total per target: a single user
+    (the mentor) or a whole group (everyone whose mentor_id matches). Every
+    flush_interval seconds, or as soon as max_events are waiting, the totals
+    go out as one bulk_write, so a burst of toggles on the same group becomes
+    one update instead of two per toggle.
+
+    Each flush has a batch id that the documents it changes remember, so a
+    batch that gets replayed after a crash is never counted twice. Reads call
+    pending_for() to add whatever hasn't been written yet.
+    """
+
+    def __init__(self, flush_interval: float = 0.2, max_events: int = 100, recover_after: float = 60):
+        self.flush_interval = flush_interval
+        self.max_events = max_events
+        self.recover_after = recover_after
+        self._queue = []     # event ids not flushed yet
+        self._pending = {}   # (target, target_id) -> points, for events in the queue
+        self._inflight = {}  # batch_id -> {(target, target_id): points}, claimed but not applied yet
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+        self.events = 0
+        self.flushes = 0
+        self.writes = 0
+        self.failures = 0
+        self.swept = 0
+
+    def _add_pending(self, totals: dict, target, target_id, points):
+        key = (target, target_id)
+        totals[key] = totals.get(key, 0) + points
+        if not totals[key]:
+            del totals[key]
+
+    async def award(self, mentor_id, points: int, reason: dict = None):
+        """
+        Giving points to a mentor and everyone in their group
+        """
+        now = datetime.now(timezone.utc)
+        events = [
+            {"target": target, "target_id": mentor_id, "points": points, "reason": reason or {},
+             "created_at": now, "batch_id": None, "applied_at": None}
+            for target in ("user", "group")
+        ]
+        await points_events.insert_many(events)
+        for event in events:
+            self._queue.append(event["_id"])
+            self._add_pending(self._pending, event["target"], mentor_id, points)
+        self.events += len(events)
+
+        if self._task is None or len(self._queue) >= self.max_events:
+            # No background flusher (or it's falling behind): write now
+            if self._task is None:
+                await self.flush()
+            else:
+                self._wake.set()
+
+    def pending_for(self, user: dict):
+        """
+        Points awarded to a user that aren't in their document yet
+        """
+        points = 0
+        for totals in (self._pending, *self._inflight.values()):
+            points += totals.get(("user", user.get("_id")), 0)
+            if user.get("mentor_id") is not None:
+                points += totals.get(("group", user["mentor_id"]), 0)
+        return points
+
+    def with_pending(self, user: dict):
+        if "points" in user:
+            user["points"] = user.get("points", 0) + self.pending_for(user)
+        return user
+
+    async def flush(self):
+        async with self._lock:
+            # Batches a failed flush left behind go first
+            for batch_id in list(self._inflight):
+                await self._apply(batch_id)
+
+            if not self._queue:
+                return
+            event_ids, pending = self._queue, self._pending
+            self._queue, self._pending = [], {}
+            batch_id = ObjectId()
+            self._inflight[batch_id] = pending
+            try:
+                # Claiming them means nobody else (e.g. another instance recovering) applies them too
+                await points_events.update_many(
+                    {"_id": {"$in": event_ids}, "batch_id": None},
+                    {"$set": {"batch_id": batch_id}}
+                )
+            except Exception as e:
+                # Put them back, the next flush tries again
+                del self._inflight[batch_id]
+                self._queue = event_ids + self._queue
+                for (target, target_id), points in pending.items():
+                    self._add_pending(self._pending, target, target_id, points)
+                self.failures += 1
+                print(f"Could not claim points events: {e}")
+                return
+            await self._apply(batch_id)
+
+    async def _apply(self, batch_id):
+        try:
+            applied, touched = await apply_batch(batch_id)
+        except Exception as e:
+            self.failures += 1
+            print(f"Points batch {batch_id} failed, will retry: {e}")
+            return False
+        # Together, with no await in between, so reads go from cached points plus
+        # pending straight to fresh points (only a read that lands while the
+        # batch is being written can briefly count it twice)
+        self._inflight.pop(batch_id, None)
+        invalidate_groups(touched)
+        self.flushes += 1
+        self.writes += applied
+        return True
+
+    async def recover(self):
+        """
+        Applying events a previous run saved but never finished. Batches that
+        were claimed are replayed as they were; unclaimed events go through
+        sweep_stranded().
+        """
+        batch_ids = await points_events.distinct("batch_id", {"applied_at": None, "batch_id": {"$ne": None}})
+        for batch_id in batch_ids:
+            invalidate_groups((await apply_batch(batch_id))[1])
+
+        recovered = await self.sweep_stranded()
+        if batch_ids or recovered:
+            print(f"Recovered {len(batch_ids)} unfinished points batches and {recovered} unflushed events")
+
+    async def sweep_stranded(self):
+        """
+        Applying unclaimed events older than recover_after, e.g. from an
+        instance that crashed and came back before they were that old. Events
+        another running instance is about to flush are younger, so they're
+        left alone. Runs on startup and then every recover_after seconds.
+        """
+        async with self._lock:
+            cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.recover_after)
+            # Our own queue gets flushed by us, even if flushes are failing for a while
+            stranded = {"applied_at": None, "batch_id": None, "created_at": {"$lt": cutoff}, "_id": {"$nin": self._queue}}
+            batch_id = ObjectId()
+            result = await points_events.update_many(stranded, {"$set": {"batch_id": batch_id}})
+            if result.modified_count:
+                invalidate_groups((await apply_batch(batch_id))[1])
+            return result.modified_count
+
+    def start(self):
+        if self.flush_interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Whatever is still waiting goes out before shutdown
+        await self.flush()
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        next_sweep = loop.time() + self.recover_after
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Points flush failed: {e}")
+
+            if loop.time() >= next_sweep:
+                next_sweep = loop.time() + self.recover_after
+                try:
+                    swept = await self.sweep_stranded()
+                    if swept:
+                        self.swept += swept
+                        print(f"Applied {swept} stranded points events")
+                except Exception as e:
+                    print(f"Points sweep failed: {e}")
+
+    def stats(self):
+        return {
+            "events": self.events,
+            "queued": len(self._queue),
+            "unfinished_batches": len(self._inflight),
+            "flushes": self.flushes,
+            "writes": self.writes,
+            "failures": self.failures,
+            "swept": self.swept,
+        }
+
+async def apply_batch(batch_id):
+    """
+    Writing one claimed batch of events to users and the group totals.
+    Safe to run again for the same batch. Returns how many updates it sent
+    and the names of the mentors whose groups changed.
+    """
+    totals = {}
+    touched = set()
+    async for event in points_events.find({"batch_id": batch_id, "applied_at": None}, {"target": 1, "target_id": 1, "points": 1}):
+        key = (event["target"], event["target_id"])
+        totals[key] = totals.get(key, 0) + event["points"]
+    totals = {key: points for key, points in totals.items() if points}
+
+    if totals:
+        # Documents remember the batch, so a replay skips the ones it already reached
+        def update(points):
+            return {
+                "$inc": {"points": points},
+                "$push": {"points_batches": {"$each": [batch_id], "$slice": -POINTS_BATCH_HISTORY}},
+            }
+
+        operations = []
+        for (target, target_id), points in totals.items():
+            if target == "user":
+                operations.append(UpdateOne({"_id": target_id, "points_batches": {"$ne": batch_id}}, update(points)))
+            else:
+                operations.append(UpdateMany({"mentor_id": target_id, "points_batches": {"$ne": batch_id}}, update(points)))
+        await users_collection.bulk_write(operations, ordered=False)
+
+        # Group leaderboard: a mentor's own points count for the group they're in,
+        # a group award counts once per member
+        user_ids = [target_id for target, target_id in totals if target == "user"]
+        group_ids = [target_id for target, target_id in totals if target == "group"]
+        mentors = {
+            user["_id"]: user async for user in users_collection.find(
+                {"_id": {"$in": user_ids + group_ids}}, {"fullName": 1, "mentor_name": 1, "mentor_id": 1}
+            )
+        }
+        members = {}
+        async for row in users_collection.aggregate([
+            {"$match": {"mentor_id": {"$in": group_ids}}},
+            {"$group": {"_id": "$mentor_id", "count": {"$sum": 1}}},
+        ]):
+            members[row["_id"]] = row["count"]
+
+        group_deltas = {}
+        for (target, target_id), points in totals.items():
+            mentor = mentors.get(target_id, {})
+            mentor_name = mentor.get("fullName") or mentor_directory.name_of(target_id)
+            touched.add(mentor_name)
+            if target == "user":
+                group, delta = group_key(mentor.get("mentor_name"), mentor.get("mentor_id")), points
+            else:
+                group, delta = target_id, points * members.get(target_id, 0)
+            if group is not None:
+                group_deltas[group] = group_deltas.get(group, 0) + delta
+        await record_many_group_points(group_deltas, batch_id)
+
+    await points_events.update_many(
+        {"batch_id": batch_id, "applied_at": None},
+        {"$set": {"applied_at": datetime.now(timezone.utc)}}
+    )
+    return len(totals), touched
+
+# POINTS_FLUSH_INTERVAL_MS=0 writes every award straight away (still through the event log)
+points_ledger = PointsLedger(
+    flush_interval=float(os.getenv("POINTS_FLUSH_INTERVAL_MS", 200)) / 1000,
+    max_events=int(os.getenv("POINTS_FLUSH_MAX_EVENTS", 100)),
+    recover_after=float(os.getenv("POINTS_RECOVER_AFTER_SECONDS", 60)),
+)
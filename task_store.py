@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta, timezone
+from uuid import NAMESPACE_URL, uuid4, uuid5
+from pymongo import UpdateOne
+from database import db
+
+# One document per bucket list task:
+# {"_id", "id": task id from the URLs, "mentor_id", "description", "completed", "created_at"}
+# The bucket_lists document keeps "task_count" and "completed_count" for the list.
+tasks_collection = db["tasks"]
+bucketlist_collection = db["bucket_lists"]
+
+# Sort order for listing tasks, oldest first. "id" breaks ties between tasks
+# created in the same millisecond so pages never skip or repeat one.
+TASK_SORT_KEYS = ("created_at", "id")
+
+def new_task(mentor_id, description: str, task_id: str = None):
+    return {
+        "id": task_id or str(uuid4()),
+        "mentor_id": mentor_id,
+        "description": description,
+        "completed": False,
+        "created_at": datetime.now(timezone.utc),
+    }
+
+async def update_task_counts(mentor_id, tasks: int = 0, completed: int = 0, mentor_name: str = None):
+    """
+    Keeping a bucket list's task_count/completed_count in step with a change
+    to its tasks. Call this from every code path that adds, removes or toggles one.
+    Passing mentor_name creates the bucket list if the mentor doesn't have one yet.
+    """
+    changes = {name: delta for name, delta in (("task_count", tasks), ("completed_count", completed)) if delta}
+    if not changes:
+        return
+    update = {"$inc": changes}
+    if mentor_name:
+        update["$setOnInsert"] = {"mentor_name": mentor_name}
+    await bucketlist_collection.update_one({"mentor_id": mentor_id}, update, upsert=bool(mentor_name))
+
+async def recount_tasks(mentor_id):
+    """
+    Setting a bucket list's counters from the tasks themselves
+    """
+    task_count = await tasks_collection.count_documents({"mentor_id": mentor_id})
+    completed_count = await tasks_collection.count_documents({"mentor_id": mentor_id, "completed": True})
+    await bucketlist_collection.update_one(
+        {"mentor_id": mentor_id},
+        {"$set": {"task_count": task_count, "completed_count": completed_count}}
+    )
+    return task_count, completed_count
+
+def legacy_task_id(bucket: dict, task: dict, position: int):
+    """
+    Older tasks keep their id under "id", "task_id" or "_id" (sometimes an
+    ObjectId). Tasks with none at all get one made from their place in the
+    list, so running the migration again gives them the same id.
+    """
+    for field in ("id", "task_id", "_id"):
+        if task.get(field) is not None:
+            return str(task[field])
+    return str(uuid5(NAMESPACE_URL, f"bucket_lists/{bucket['_id']}/{position}"))
+
+async def _migrate_bucket_list(bucket: dict):
+    mentor_id = bucket.get("mentor_id")
+    legacy_tasks = bucket.get("tasks") or []
+    # Spacing created_at out by a millisecond keeps the tasks in their old order
+    base = datetime.now(timezone.utc)
+    updates = []
+    seen = set()
+    for position, task in enumerate(legacy_tasks):
+        if not isinstance(task, dict):
+            continue
+        task_id = legacy_task_id(bucket, task, position)
+        if task_id in seen:
+            # The old array allowed duplicate ids, which could never be told apart
+            task_id = f"{task_id}-{position}"
+        seen.add(task_id)
+        doc = {
+            "id": task_id,
+            "mentor_id": mentor_id,
+            "description": task.get("description", ""),
+            "completed": task.get("completed") is True,
+            "created_at": base + timedelta(milliseconds=position),
+        }
+        # Upserting on the id makes a rerun after a crash a no-op for tasks already moved
+        updates.append(UpdateOne({"mentor_id": mentor_id, "id": task_id}, {"$setOnInsert": doc}, upsert=True))
+    if updates:
+        await tasks_collection.bulk_write(updates, ordered=False)
+
+    # Only drop the array if nobody changed it while we were copying it
+    result = await bucketlist_collection.update_one(
+        {"_id": bucket["_id"], "tasks": bucket["tasks"]},
+        {"$unset": {"tasks": ""}}
+    )
+    if result.modified_count == 0:
+        return None
+    await recount_tasks(mentor_id)
+    return len(updates)
+
+async def migrate_embedded_tasks(max_attempts: int = 3):
+    """
+    Moving tasks out of the old bucket_lists.tasks arrays into the tasks
+    collection, one list at a time so the app keeps working while it runs.
+    A list that changes mid-copy is read again and copied again. Runs on
+    startup and does nothing once every list has been moved. Lists whose
+    mentor has no account (so no mentor_id) are left where they are.
+    """
+    lists = tasks = 0
+    cursor = bucketlist_collection.find(
+        {"tasks": {"$exists": True}, "mentor_id": {"$ne": None}}, {"mentor_id": 1, "tasks": 1}
+    )
+    async for bucket in cursor:
+        for _ in range(max_attempts):
+            moved = await _migrate_bucket_list(bucket)
+            if moved is not None:
+                lists += 1
+                tasks += moved
+                break
+            bucket = await bucketlist_collection.find_one({"_id": bucket["_id"]}, {"mentor_id": 1, "tasks": 1})
+            if bucket is None or "tasks" not in bucket:
+                break
+        else:
+            print(f"Bucket list {bucket['_id']} kept changing, its tasks will be moved on the next start")
+    if lists:
+        print(f"Moved {tasks} tasks from {lists} bucket lists into the tasks collection")
+    return tasks
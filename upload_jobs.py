@@ -0,0 +1,170 @@
+import asyncio
+import os
+import random
+import time
+from collections import OrderedDict
+from uuid import uuid4
+from database import db
+from cloudinary_config import cloudinary, cloudinary_configured
+from user_cache import invalidate_user
+import cloudinary.uploader
+
+class QueueFull(Exception):
+    """
+    Raised when there are already too many uploads waiting
+    """
+
+async def cloudinary_uploader(payload):
+    # The Cloudinary SDK is blocking, so it runs in a thread
+    result = await asyncio.to_thread(cloudinary.uploader.upload, payload, resource_type="auto")
+    return result.get("secure_url")
+
+class StubUploader:
+    """
+    Stand-in for Cloudinary when developing or testing locally. Pretends to
+    upload after `delay` seconds and fails the first `fail_times` calls.
+    """
+
+    def __init__(self, delay: float = 0.0, fail_times: int = 0):
+        self.delay = delay
+        self.fail_times = fail_times
+        self.calls = 0
+
+    async def __call__(self, payload):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.calls <= self.fail_times:
+            raise ConnectionError("Stub upload failed")
+        return f"https://stub-cdn.local/{uuid4()}"
+
+class UploadJobQueue:
+    """
+    Runs profile picture uploads in the background. A fixed number of workers
+    take jobs off a bounded queue, retry failures with exponential backoff,
+    and set the user's profile_pic once the upload is done. Job status is
+    kept in memory (most recent max_jobs_kept jobs) for the status endpoint.
+
+    The user remembers the id of their latest job (profile_pic_job), and a
+    job only sets profile_pic if it's still the latest, so a slow or retried
+    upload never replaces a picture the user changed after it.
+    """
+
+    def __init__(self, uploader=None, concurrency: int = 2, max_queued: int = 100,
+                 max_attempts: int = 4, base_delay: float = 1.0, max_jobs_kept: int = 1000):
+        self.uploader = uploader or cloudinary_uploader
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_jobs_kept = max_jobs_kept
+        self.jobs = OrderedDict()  # job_id -> status dict
+        self._queue = asyncio.Queue(maxsize=max_queued)
+        self._workers = []
+
+    async def submit(self, email: str, payload):
+        """
+        Queueing an upload for a user. `payload` is anything the uploader
+        accepts (a data URL string or a file object). Returns the job status.
+        """
+        self._start_workers()
+        if self._queue.full():
+            raise QueueFull("Too many uploads in progress")
+        job = {
+            "job_id": str(uuid4()),
+            "email": email.strip(),
+            "status": "pending",
+            "attempts": 0,
+            "image_url": None,
+            "error": None,
+            "created_at": time.time(),
+        }
+        # Recorded before the job can run, so it can't finish before it's the latest
+        await db.users.update_one({"email": job["email"]}, {"$set": {"profile_pic_job": job["job_id"]}})
+        try:
+            self._queue.put_nowait((job, payload))
+        except asyncio.QueueFull:
+            raise QueueFull("Too many uploads in progress")
+
+        self.jobs[job["job_id"]] = job
+        while len(self.jobs) > self.max_jobs_kept:
+            self.jobs.popitem(last=False)
+        return job
+
+    def get(self, job_id: str):
+        return self.jobs.get(job_id)
+
+    def _start_workers(self):
+        # Started on first use so the queue works without any app startup hook
+        self._workers = [worker for worker in self._workers if not worker.done()]
+        while len(self._workers) < self.concurrency:
+            self._workers.append(asyncio.create_task(self._work()))
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _work(self):
+        while True:
+            job, payload = await self._queue.get()
+            try:
+                await self._run(job, payload)
+            except Exception as e:
+                print(f"Upload job {job['job_id']} crashed: {e}")
+                job["status"] = "failed"
+                job["error"] = str(e)
+            finally:
+                if hasattr(payload, "close"):
+                    payload.close()
+                self._queue.task_done()
+
+    async def _run(self, job: dict, payload):
+        job["status"] = "running"
+        while True:
+            job["attempts"] += 1
+            try:
+                if hasattr(payload, "seek"):
+                    payload.seek(0)  # retries re-read file payloads from the start
+                image_url = await self.uploader(payload)
+                break
+            except Exception as e:
+                job["error"] = str(e)
+                if job["attempts"] >= self.max_attempts:
+                    job["status"] = "failed"
+                    print(f"Upload job {job['job_id']} failed after {job['attempts']} attempts: {e}")
+                    return
+                # Exponential backoff with a bit of jitter so retries don't line up
+                delay = self.base_delay * 2 ** (job["attempts"] - 1)
+                await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+
+        job["image_url"] = image_url
+        job["error"] = None
+        result = await db.users.update_one(
+            {"email": job["email"], "profile_pic_job": job["job_id"]},
+            {"$set": {"profile_pic": image_url}, "$unset": {"profile_pic_job": ""}}
+        )
+        if result.matched_count == 0:
+            # The user uploaded another picture after this one
+            job["status"] = "superseded"
+            return
+        invalidate_user(job["email"])
+        job["status"] = "succeeded"
+
+    def stats(self):
+        counts = {}
+        for job in self.jobs.values():
+            counts[job["status"]] = counts.get(job["status"], 0) + 1
+        return {"queued": self._queue.qsize(), "workers": len(self._workers), "jobs": counts}
+
+# UPLOAD_JOB_UPLOADER=stub swaps Cloudinary for StubUploader when running locally
+USE_STUB_UPLOADER = os.getenv("UPLOAD_JOB_UPLOADER", "").lower() == "stub"
+
+upload_jobs = UploadJobQueue(
+    uploader=StubUploader() if USE_STUB_UPLOADER else None,
+    concurrency=int(os.getenv("UPLOAD_JOB_CONCURRENCY", 2)),
+    max_queued=int(os.getenv("UPLOAD_JOB_MAX_QUEUED", 100)),
+    max_attempts=int(os.getenv("UPLOAD_JOB_MAX_ATTEMPTS", 4)),
+)
+
+def background_uploads_enabled():
+    return USE_STUB_UPLOADER or cloudinary_configured()
@@ -0,0 +1,53 @@
+import os
+from database import db
+from cache import TTLCache, SingleFlight
+from models import LOGIN_PROJECTION
+
+# Profile fields plus the password hash, so login can use the same entries
+user_cache = TTLCache(
+    max_entries=int(os.getenv("USER_CACHE_MAX_ENTRIES", 5000)),
+    ttl_seconds=float(os.getenv("USER_CACHE_TTL_SECONDS", 60)),
+)
+user_loads = SingleFlight()
+
+def normalize_email(email: str):
+    # Same normalization the routes already apply before querying;
+    # emails are matched case-sensitively in Mongo so case is kept
+    return email.strip()
+
+async def get_user(email: str):
+    """
+    Fetching a user by email through the cache. Returns a copy of the
+    document (including the password hash) or None if there's no such user.
+    """
+    key = normalize_email(email)
+    user = user_cache.get(key)
+    if user is None:
+        # keyed on the generation too, so nobody joins a load that started before a write
+        generation = user_cache.generation
+        user = await user_loads.run((key, generation), lambda: _load_user(key, generation))
+    return dict(user) if user is not None else None
+
+async def _load_user(key: str, generation: int):
+    user = await db.users.find_one({"email": key}, LOGIN_PROJECTION)
+    if user is not None:
+        user_cache.put(key, user, generation)
+    return user
+
+def without_password(user: dict):
+    user.pop("password", None)
+    return user
+
+def invalidate_user(email: str):
+    user_cache.invalidate(normalize_email(email))
+
+def invalidate_group(mentor_name: str):
+    """
+    Points changed for a mentor and everyone in their group
+    """
+    user_cache.invalidate_where(
+        lambda user: user.get("fullName") == mentor_name or user.get("mentor_name") == mentor_name
+    )
+
+def user_cache_stats():
+    return {**user_cache.stats(), "shared_loads": user_loads.shared}
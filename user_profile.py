@@ -1,34 +1,45 @@
-from fastapi import File, UploadFile, APIRouter, HTTPException, Query
+from fastapi import File, UploadFile, APIRouter, HTTPException, Query, Request
 from fastapi.responses import JSONResponse
 from database import db
-from models import Profile, ProfileOut, UpdateProfile, ProfilePicUpdate
+from leaderboard import record_group_points, group_key
+from pagination import paginate, MAX_PAGE_SIZE
+from responses import FastJSONResponse
+from user_cache import get_user, invalidate_user, without_password
+from image_store import iter_upload_file, iter_base64, spool
+from image_records import store_image
+from mentors import mentor_directory, rename_mentor
+from points_ledger import points_ledger
+from models import Profile, ProfileOut, UpdateProfile, ProfilePicUpdate, PROFILE_PROJECTION
 from pymongo import ReturnDocument
 from typing import List, Optional
-from cloudinary_config import cloudinary
-import cloudinary.uploader
+from pydantic import ValidationError
+from starlette.datastructures import UploadFile as StarletteUploadFile
+from upload_jobs import upload_jobs, background_uploads_enabled, QueueFull
 
 profile_router = APIRouter()
 users_collection = db["users"]
 
 @profile_router.get("/role/{account_type}", response_model=List[ProfileOut])
-async def get_by_role(account_type: str):
-    cursor = users_collection.find({"accountType": account_type})
-    
-    if not cursor:
-        raise HTTPException(status_code=404, detail=f"No users found for role {account_type}")
-    
-    users = []
-    async for doc in cursor:
-        doc["_id"] = str(doc["_id"])
-        users.append(doc)
-    return users
+async def get_by_role(
+    account_type: str,
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+):
+    # one page at a time, walking the (accountType, _id) index
+    return await paginate(
+        request, users_collection,
+        {"accountType": account_type},
+        limit=limit, after=after,
+        projection=PROFILE_PROJECTION
+    )
 
 # GET PROFILE INFO OF USER
 @profile_router.get("", response_model=ProfileOut)
 async def get_profile(email: str):
     print(f"Received email: {email}")  # debugging (remember to remove later)
     try:
-        user = await users_collection.find_one({"email": email.strip()}) # strip whitespace from email
+        user = await get_user(email) # cached, and strips whitespace from email
         print("Finished search")
     except Exception as e:
         print(f"Exception during database query: {e}")
@@ -37,8 +48,8 @@ async def get_profile(email: str):
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    user["_id"] = str(user["_id"]) # convert ObjectID to str
-    return user
+    # already projected to ProfileOut's fields, no need to validate it again
+    return FastJSONResponse(points_ledger.with_pending(without_password(user)))
 
 # UPDATE USER INFORMATION
 @profile_router.put("", response_model=ProfileOut)
@@ -61,92 +72,143 @@ async def update_profile(
     
     # If there's at least one field to update:
     if len(update_data) > 0:
-        update_result = await users_collection.find_one_and_update(
+        # Changing groups means pointing at the new mentor's id too
+        if "mentor_name" in update_data:
+            mentor_id = await mentor_directory.resolve(update_data["mentor_name"])
+            update_data["mentor_id"] = mentor_id
+            if mentor_id is not None:
+                # An old name of a mentor who has since renamed gets their current one
+                update_data["mentor_name"] = mentor_directory.name_of(mentor_id)
+
+        previous = await users_collection.find_one_and_update(
            {"email": email.strip()},    # get user with email
            {"$set": update_data},       # set fields in the 'update_data' dict
-           return_document=ReturnDocument.AFTER     # makes mongo return updated version of document
+           projection=PROFILE_PROJECTION,
+           return_document=ReturnDocument.BEFORE     # old version, so we can see if the user changed groups
         )
 
         # if user was found and updated, return string version of id
-        if update_result is not None:
-            update_result["_id"] = str(update_result["_id"])
-            return update_result
+        if previous is not None:
+            invalidate_user(email)
+            # moving groups moves this user's points between the group totals
+            old_group = group_key(previous.get("mentor_name"), previous.get("mentor_id"))
+            new_group = group_key(
+                update_data.get("mentor_name", previous.get("mentor_name")),
+                update_data.get("mentor_id", previous.get("mentor_id"))
+            )
+            if new_group != old_group:
+                await record_group_points(old_group, -previous.get("points", 0))
+                await record_group_points(new_group, previous.get("points", 0))
+
+            # A mentor's name is shown on their whole group, so carry it over
+            new_name = update_data.get("fullName")
+            if previous.get("accountType") == "Mentor" and new_name and new_name != previous.get("fullName"):
+                await rename_mentor(previous["_id"], previous.get("fullName"), new_name)
+
+            return FastJSONResponse({**previous, **update_data})
         else:
             raise HTTPException(status_code=404, detail=f"User not found")
     
     raise HTTPException(status_code=400, detail="No fields to update")
 
-@profile_router.put("/image", response_model=ProfileOut)
-async def upload_image(data: ProfilePicUpdate, email: str = Query(...)):
+# What PUT /profile/image accepts, for the API docs
+PROFILE_IMAGE_BODY = {
+    "requestBody": {
+        "content": {
+            "multipart/form-data": {
+                "schema": {"type": "object", "properties": {"file": {"type": "string", "format": "binary"}}}
+            },
+            "image/*": {"schema": {"type": "string", "format": "binary"}},
+            "application/json": {"schema": ProfilePicUpdate.model_json_schema()},
+        }
+    }
+}
+
+async def read_profile_picture(request: Request):
+    """
+    Working out what kind of upload this is. Returns (chunks, content_type, legacy_data_url):
+    - multipart/form-data with a "file" field, streamed from the spooled upload
+    - a raw image/* body, streamed straight from the request
+    - legacy JSON {"profile_pic": "<base64 or data URL>"}, decoded a piece at a time
+    """
+    content_type = request.headers.get("content-type", "")
+
+    if content_type.startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("file") or form.get("profile_pic")
+        if not isinstance(upload, StarletteUploadFile):
+            raise HTTPException(status_code=400, detail="Multipart upload needs a 'file' field")
+        return iter_upload_file(upload), upload.content_type or "", None
+
+    if content_type.startswith("image/"):
+        return request.stream(), content_type.split(";")[0].strip(), None
+
+    # Legacy base64-in-JSON
     try:
-        profile_pic_base64 = data.profile_pic
+        data = ProfilePicUpdate(**await request.json())
+    except (ValueError, TypeError, ValidationError):
+        raise HTTPException(status_code=422, detail="Expected an image upload or JSON with a base64 profile_pic")
+    profile_pic_base64 = data.profile_pic
+
+    # Strip the base64 prefix if it exists
+    if "," in profile_pic_base64:
+        _, data_string = profile_pic_base64.split(",", 1)
+    else:
+        data_string = profile_pic_base64
+
+    # Get content type (defaults to png if not detectable)
+    legacy_type = "image/png"
+    if profile_pic_base64.startswith("data:"):
+        legacy_type = profile_pic_base64.split(";")[0].replace("data:", "")
+    return iter_base64(data_string), legacy_type, profile_pic_base64
+
+@profile_router.put(
+    "/image",
+    response_model=ProfileOut,
+    responses={202: {"description": "Upload queued, poll /profile/image/jobs/{job_id} for the result"}},
+    openapi_extra=PROFILE_IMAGE_BODY
+)
+async def upload_image(request: Request, email: str = Query(...)):
+    try:
+        chunks, content_type, legacy_data_url = await read_profile_picture(request)
+        if not content_type.startswith("image/"):
+            raise HTTPException(status_code=400, detail="File must be an image")
         image_url = None
+
+        # Cloudinary uploads happen in the background so the request doesn't wait on the CDN
+        if background_uploads_enabled():
+            if not await get_user(email):
+                raise HTTPException(status_code=404, detail="User not found")
+            # Binary uploads are copied to a temp file the job can read after this request ends
+            payload = legacy_data_url if legacy_data_url is not None else await spool(chunks)
+            try:
+                job = await upload_jobs.submit(email, payload)
+            except QueueFull:
+                if hasattr(payload, "close"):
+                    payload.close()
+                raise HTTPException(status_code=503, detail="Too many uploads in progress, please try again", headers={"Retry-After": "5"})
+            return FastJSONResponse(
+                {"job_id": job["job_id"], "status": job["status"]},
+                status_code=202
+            )
         
-        # Try using Cloudinary if configured properly
+        # Fallback to local storage if Cloudinary isn't configured
         try:
-            if (cloudinary.config().cloud_name and 
-                cloudinary.config().api_key and 
-                cloudinary.config().api_secret and
-                cloudinary.config().cloud_name != "your_cloud_name"):
-                
-                upload_result = cloudinary.uploader.upload(
-                    profile_pic_base64,
-                    resource_type="auto"
-                )
-                image_url = upload_result.get("secure_url")
-            else:
-                # Fallback to local storage if Cloudinary isn't configured
-                print("Cloudinary not configured. Using local storage.")
-                
-                # Convert base64 to binary data
-                import base64
-                import io
-                from bson import ObjectId
-                
-                # Strip the base64 prefix if it exists
-                if "," in profile_pic_base64:
-                    _, data_string = profile_pic_base64.split(",", 1)
-                else:
-                    data_string = profile_pic_base64
-                
-                # Convert to binary
-                file_data = base64.b64decode(data_string)
-                
-                # Get content type (defaults to png if not detectable)
-                content_type = "image/png"
-                if profile_pic_base64.startswith("data:"):
-                    content_type = profile_pic_base64.split(";")[0].replace("data:", "")
-                
-                # Metadata
-                metadata = {
-                    "filename": f"{email}_profile.{content_type.split('/')[1]}",
-                    "content_type": content_type,
-                    "user_id": email,
-                    "is_profile_picture": True
-                }
-                
-                # Store in GridFS
-                # First, create a file entry
-                file_doc = {
-                    "filename": metadata["filename"],
-                    "metadata": metadata,
-                    "length": len(file_data)
-                }
-                
-                # Insert file info
-                result = await db.fs.files.insert_one(file_doc)
-                file_id = result.inserted_id
-                
-                # Insert file data
-                chunk_doc = {
-                    "files_id": file_id,
-                    "n": 0,  # Chunk number
-                    "data": file_data
-                }
-                await db.fs.chunks.insert_one(chunk_doc)
-                
-                # Set URL to the images endpoint
-                image_url = f"/images/{str(file_id)}"
+            print("Cloudinary not configured. Using local storage.")
+            
+            # Metadata
+            metadata = {
+                "filename": f"{email}_profile.{content_type.split('/')[1]}",
+                "content_type": content_type,
+                "user_id": email,
+                "is_profile_picture": True
+            }
+            
+            # Stored as fixed-size chunks in GridFS, or shared with an identical image already there
+            file_id, _, _ = await store_image(chunks, metadata["filename"], metadata)
+            
+            # Set URL to the images endpoint
+            image_url = f"/images/{str(file_id)}"
         except Exception as e:
             print(f"Image storage error: {e}")
             # Use a fallback URL if all else fails
@@ -157,15 +219,27 @@ async def upload_image(data: ProfilePicUpdate, email: str = Query(...)):
 
         update_result = await users_collection.find_one_and_update(
             {"email": email.strip()},
-            {"$set": update_data},
+            # Any background upload still running is older than this picture
+            {"$set": update_data, "$unset": {"profile_pic_job": ""}},
+            projection=PROFILE_PROJECTION,
             return_document=ReturnDocument.AFTER
         )
 
         if update_result is not None:
-            update_result["_id"] = str(update_result["_id"])
-            return update_result
+            invalidate_user(email)
+            return FastJSONResponse(update_result)
 
         raise HTTPException(status_code=404, detail="User not found")
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Image upload failed: {str(e)}")
+
+# CHECK ON A BACKGROUND PROFILE PICTURE UPLOAD
+@profile_router.get("/image/jobs/{job_id}")
+async def get_upload_job(job_id: str):
+    job = upload_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Upload job not found")
+    return {key: value for key, value in job.items() if key != "email"}